@@ -0,0 +1,533 @@
+# coding: utf8
+"""
+asyncio版的functool decorator, 需要Python 3.7+ (asyncio.run)
+参数和语义与functool中的同名decorator相同, 用于async def函数, 等待时用asyncio.sleep, 不阻塞event loop.
+缓存类的decorator(throttle, memoize, single_flight)让并发的调用共享同一个正在执行的awaitable.
+rate_limit使用ratelimit中的limiter.
+
+与functool的不同:
+- 只在一个event loop中使用, 不需要锁; memoize的shards参数只为兼容, 不分片, LRU是精确的
+- memoize同一个key同时未命中时只执行一次, 不需要再配合single_flight
+- 调用被cancel时不cancel共享的执行, 其他调用照常得到结果
+"""
+
+import asyncio, functools, logging, random, sys, time
+from collections import OrderedDict
+from pyutil import make_hash
+from ratelimit import KeyedRateLimiter, RateLimited
+
+
+_KWD_MARK = object() # separates args from kwargs in a key, like functools._make_key
+
+
+def _make_key(args, kwargs):
+    """cache key of a call, falls back to pyutil.make_hash for unhashable args"""
+    key = args + (_KWD_MARK,) + tuple(sorted(kwargs.items())) if kwargs else args
+    try:
+        hash(key)
+    except TypeError:
+        key = make_hash([args, kwargs])
+    return key
+
+
+def _fmt_exception(e):
+    """fmtutil.fmt_exception for Python 3, where str is already unicode"""
+    return '%s(%s)' % (e.__class__.__name__, e)
+
+
+def _retrieve(future):
+    """done callback of a shared task, so a failure nobody awaited is not
+    reported as never retrieved"""
+    if not future.cancelled():
+        future.exception()
+
+
+def _check_coroutine(func):
+    if not asyncio.iscoroutinefunction(func):
+        raise TypeError('%r is not an async def function, use functool for plain functions' % func)
+
+
+class _ThrottleEntry(object):
+    __slots__ = ('cache_at', 'value', 'has_value', 'future')
+
+    def __init__(self):
+        self.cache_at = None # 计算开始的时间
+        self.value = None
+        self.has_value = False
+        self.future = None # 第一次计算的task, 其他调用等待它
+
+
+def throttle(wait, exception_wait=0, keyed=False, max_keys=1000, key_func=None):
+    u"""
+    在指定时间间隔内, 只调用一次的decorator, 见functool.throttle.
+    第一次计算未完成时, 其他调用await同一个计算.
+
+    wait - in ms. 两次调用的间隔时间
+    exception_wait - in ms. 发生异常时下次调用的间隔. 0表示下次调用无需间隔
+    keyed - 为True时按参数分别缓存
+    max_keys - keyed时最多缓存的参数组数, 超过时淘汰最久未用的
+    key_func - keyed时由key_func(*args, **kwargs)计算缓存的key, 默认用全部参数
+
+    >>> @throttle(wait=1000)
+    ... async def load_urls():
+    ...   print('loaded')
+    ...   await asyncio.sleep(0.01)
+    ...   return 'ok'
+    >>> async def main():
+    ...   return await asyncio.gather(load_urls(), load_urls(), load_urls())
+    >>> asyncio.run(main())
+    loaded
+    ['ok', 'ok', 'ok']
+
+    >>> throttled = throttle(wait=10000, keyed=True) # 同一个decorator装饰的函数各自缓存
+    >>> async def a(x):
+    ...   return 'a%s' % x
+    >>> async def b(x):
+    ...   return 'b%s' % x
+    >>> a, b = throttled(a), throttled(b)
+    >>> async def main():
+    ...   return await a(1), await b(1)
+    >>> asyncio.run(main())
+    ('a1', 'b1')
+    """
+
+    wait = wait / 1000.0
+    exception_wait = exception_wait / 1000.0
+    max_keys = max_keys if keyed else 1
+
+    def wrapper(f):
+        _check_coroutine(f)
+        entries = OrderedDict() # key -> _ThrottleEntry, 按最近使用排序, 每个函数各自一份
+
+        async def compute(entry, args, kwargs):
+            try:
+                value = await f(*args, **kwargs)
+            except BaseException:
+                if not entry.has_value:
+                    entry.has_value = True # 其他调用得到None, 与functool.throttle相同
+                entry.cache_at = time.time() - wait + exception_wait
+                raise
+            entry.value, entry.has_value = value, True
+            return value
+
+        @functools.wraps(f)
+        async def throttled(*args, **kwargs):
+            if not keyed:
+                key = None
+            elif key_func:
+                key = key_func(*args, **kwargs)
+            else:
+                key = _make_key(args, kwargs)
+            entry = entries.pop(key, None)
+            if entry is None:
+                entry = _ThrottleEntry()
+            entries[key] = entry
+            if len(entries) > max_keys:
+                entries.popitem(last=False)
+            now = time.time()
+            if entry.cache_at and now - entry.cache_at < wait:
+                if entry.has_value:
+                    return entry.value
+                try:
+                    return await asyncio.shield(entry.future)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    return entry.value
+
+            entry.cache_at = now
+            future = asyncio.ensure_future(compute(entry, args, kwargs))
+            future.add_done_callback(_retrieve)
+            if not entry.has_value:
+                entry.future = future
+            return await asyncio.shield(future)
+        return throttled
+
+    return wrapper
+
+
+class SingleFlightTimeout(asyncio.TimeoutError):
+    pass
+
+
+def single_flight(key_func=None, timeout=None):
+    u"""
+    合并并发调用的decorator, 见functool.single_flight: 参数相同的调用同时进行时只执行一次,
+    其他调用await同一个执行, 得到同一个结果或异常. 某个调用被cancel不影响执行和其他调用.
+
+    key_func - 由key_func(*args, **kwargs)计算key, 默认用全部参数(不可hash时用pyutil.make_hash)
+    timeout - in seconds. 等待的调用最多等待的时间, 超时抛出SingleFlightTimeout;
+        执行超过timeout后, 新的调用不再等待这次执行, 而是重新执行
+
+    >>> calls = []
+    >>> @single_flight()
+    ... async def load(key):
+    ...   calls.append(key)
+    ...   await asyncio.sleep(0.01)
+    ...   return key * 2
+    >>> async def main():
+    ...   return await asyncio.gather(*[load(21) for _ in range(5)])
+    >>> asyncio.run(main()), calls
+    ([42, 42, 42, 42, 42], [21])
+
+    >>> @single_flight(timeout=0.05)
+    ... async def slow(key):
+    ...   calls.append(key)
+    ...   await asyncio.sleep(0.1)
+    ...   return key
+    >>> async def late(delay):
+    ...   await asyncio.sleep(delay)
+    ...   try:
+    ...     return await slow(1)
+    ...   except SingleFlightTimeout:
+    ...     return 'timeout'
+    >>> del calls[:]
+    >>> async def main():
+    ...   return await asyncio.gather(slow(1), late(0.01), late(0.07))
+    >>> asyncio.run(main()), calls # 执行者不超时, 超时后的调用重新执行
+    ([1, 'timeout', 1], [1, 1])
+    """
+
+    def wrapper(f):
+        _check_coroutine(f)
+        flights = {} # key -> (开始时间, 正在执行的task)
+
+        def land(key, flight):
+            if flights.get(key) is flight: # 超时后可能已换成新的执行
+                del flights[key]
+
+        @functools.wraps(f)
+        async def coalesced(*args, **kwargs):
+            key = key_func(*args, **kwargs) if key_func else _make_key(args, kwargs)
+            now = time.time()
+            flight = flights.get(key)
+            if flight is None or (timeout is not None and now - flight[0] >= timeout):
+                future = asyncio.ensure_future(f(*args, **kwargs))
+                flight = flights[key] = (now, future)
+                future.add_done_callback(lambda _: land(key, flight))
+                future.add_done_callback(_retrieve)
+                return await asyncio.shield(future)
+            started_at, future = flight
+            remaining = None if timeout is None else started_at + timeout - now
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), remaining)
+            except asyncio.TimeoutError:
+                if future.done():
+                    raise # f自己抛出的TimeoutError
+                raise SingleFlightTimeout('%s%r still running after %ss' % (f.__name__, args, timeout))
+        return coalesced
+
+    return wrapper
+
+
+def memoize(ttl=None, max_entries=1024, max_bytes=None, sizeof=sys.getsizeof,
+        cache_exceptions=(), exception_ttl=None, key_func=None, shards=None):
+    u"""
+    缓存函数结果的decorator, 见functool.memoize. 同一个key同时未命中时只执行一次.
+
+    ttl - in seconds. 结果的有效期, None表示不过期
+    max_entries - 最多缓存的结果数, 超过时淘汰最久未用的, None表示不限(只用max_bytes限制)
+    max_bytes - 结果总大小的上限(近似值, 由sizeof计算), None表示不限
+    sizeof - 计算结果大小的函数, 默认sys.getsizeof (不含引用的对象)
+    cache_exceptions - 需要缓存的异常类(tuple)
+    exception_ttl - in seconds. 异常的有效期, 默认同ttl
+    key_func - 由key_func(*args, **kwargs)计算缓存的key, 默认用全部参数
+    shards - 只为与functool.memoize兼容, 一个event loop中不需要分片
+
+    >>> @memoize(ttl=10)
+    ... async def lookup(name):
+    ...   print('lookup', name)
+    ...   return name.upper()
+    >>> async def main():
+    ...   return await asyncio.gather(lookup('a'), lookup('a')), await lookup('a')
+    >>> asyncio.run(main())
+    lookup a
+    (['A', 'A'], 'A')
+    >>> info = lookup.cache_info()
+    >>> info['hits'], info['misses'], info['entries']
+    (2, 1, 1)
+
+    >>> @memoize(max_bytes=10, sizeof=len)
+    ... async def read(name):
+    ...   return name * 4
+    >>> async def main():
+    ...   return await read('a'), await read('b'), await read('c')
+    >>> asyncio.run(main()), read.cache_info()['entries'], read.cache_info()['evictions']
+    (('aaaa', 'bbbb', 'cccc'), 2, 1)
+
+    >>> @memoize(max_entries=None, max_bytes=8, sizeof=len) # 只限制大小
+    ... async def read(name):
+    ...   return name * 4
+    >>> asyncio.run(main()), read.cache_info()['entries']
+    (('aaaa', 'bbbb', 'cccc'), 2)
+
+    >>> @memoize() # 位置参数和关键字参数不会拼成相同的key
+    ... async def call(*args, **kwargs):
+    ...   return args, kwargs
+    >>> async def main():
+    ...   return await call((1,), (('a', 2),)), await call(1, a=2)
+    >>> asyncio.run(main())
+    ((((1,), (('a', 2),)), {}), ((1,), {'a': 2}))
+
+    >>> @memoize(cache_exceptions=(KeyError,))
+    ... async def find(name):
+    ...   raise KeyError(name)
+    >>> def depth(tb):
+    ...   return 0 if tb is None else 1 + depth(tb.tb_next)
+    >>> async def main():
+    ...   depths = []
+    ...   for _ in range(100):
+    ...     try:
+    ...       await find('x')
+    ...     except KeyError as e:
+    ...       depths.append(depth(e.__traceback__))
+    ...   return depths
+    >>> depths = asyncio.run(main())
+    >>> find.cache_info()['hits'], depths[1] == depths[-1] # 命中缓存的异常时traceback不会越来越长
+    (99, True)
+    """
+
+    if exception_ttl is None:
+        exception_ttl = ttl
+
+    def wrapper(f):
+        _check_coroutine(f)
+        entries = OrderedDict() # key -> (expire_at, value, exception, size) 或正在执行的task
+        info = dict(hits=0, misses=0, evictions=0, expirations=0, bytes=0)
+
+        async def compute(key, args, kwargs):
+            try:
+                value = await f(*args, **kwargs)
+            except cache_exceptions as e:
+                expire_at = None if exception_ttl is None else time.time() + exception_ttl
+                store(key, (expire_at, None, e, sizeof(e)))
+                raise
+            except BaseException:
+                discard(key)
+                raise
+            store(key, (None if ttl is None else time.time() + ttl, value, None, sizeof(value)))
+            return value
+
+        def discard(key):
+            item = entries.pop(key, None)
+            if isinstance(item, tuple):
+                info['bytes'] -= item[3]
+            return item
+
+        def store(key, item):
+            discard(key)
+            entries[key] = item
+            if isinstance(item, tuple):
+                info['bytes'] += item[3]
+            while entries and ((max_entries is not None and len(entries) > max_entries) or (max_bytes and info['bytes'] > max_bytes)):
+                old = entries.popitem(last=False)[1]
+                if isinstance(old, tuple):
+                    info['bytes'] -= old[3]
+                info['evictions'] += 1
+
+        def clear():
+            entries.clear()
+            info['bytes'] = 0
+
+        @functools.wraps(f)
+        async def memoized(*args, **kwargs):
+            key = key_func(*args, **kwargs) if key_func else _make_key(args, kwargs)
+            item = discard(key)
+            if isinstance(item, tuple) and item[0] is not None and item[0] <= time.time():
+                info['expirations'] += 1
+                item = None
+            if item is None:
+                info['misses'] += 1
+                item = asyncio.ensure_future(compute(key, args, kwargs))
+                item.add_done_callback(_retrieve)
+                store(key, item)
+                return await asyncio.shield(item)
+            store(key, item)
+            info['hits'] += 1
+            if not isinstance(item, tuple):
+                return await asyncio.shield(item)
+            if item[2] is not None:
+                raise item[2].with_traceback(None) # 否则每次raise都会在同一个异常上累积traceback
+            return item[1]
+
+        def cache_info():
+            return dict(info, entries=len(entries))
+
+        memoized.cache_info = cache_info
+        memoized.cache_clear = clear
+        return memoized
+
+    return wrapper
+
+
+class RetryBudget(object):
+    """functool.RetryBudget for one event loop: every call deposits ratio
+    tokens, every retry takes one, at most max_tokens are kept."""
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def retries(max_tries, delay=1, backoff=2, exceptions=(Exception,), ignore_exceptions=None, hook=None,
+        jitter=None, max_delay=None, max_elapsed=None, budget=None):
+    """Coroutine version of functool.retries, sleeps with asyncio.sleep.
+
+    hook may be a plain function or an async def function.
+
+    >>> tries = []
+    >>> @retries(3, delay=0.01, hook=lambda *args: None)
+    ... async def flaky():
+    ...   tries.append(1)
+    ...   if len(tries) < 3:
+    ...     raise IOError('retry me')
+    ...   return len(tries)
+    >>> asyncio.run(flaky())
+    3
+    """
+
+    def default_hook(func, tries_remaining, exception, delay):
+        log = logging.exception if tries_remaining == max_tries - 1 else logging.warning
+        log("%s: Caught '%s: %s', %d tries remaining, sleeping for %s seconds",
+                func.__name__, type(exception).__name__, exception, tries_remaining, delay)
+
+    hook = hook or default_hook
+
+    def next_sleep(base, last_sleep):
+        if jitter == 'full':
+            sleep = random.uniform(0, base)
+        elif jitter == 'decorrelated':
+            sleep = random.uniform(delay, max(last_sleep * 3, delay))
+        else:
+            sleep = base
+        return sleep if max_delay is None else min(sleep, max_delay)
+
+    def dec(func):
+        _check_coroutine(func)
+
+        @functools.wraps(func)
+        async def f2(*args, **kwargs):
+            if budget is not None:
+                budget.deposit()
+            started_at = time.time()
+            base = last_sleep = delay
+            for tries_remaining in reversed(range(max_tries)):
+                try:
+                    return await func(*args, **kwargs)
+                except exceptions as e:
+                    if ignore_exceptions and isinstance(e, ignore_exceptions):
+                        raise
+                    if not tries_remaining:
+                        raise
+                    sleep = next_sleep(base, last_sleep)
+                    if max_elapsed is not None and time.time() + sleep - started_at > max_elapsed:
+                        raise
+                    if budget is not None and not budget.withdraw():
+                        raise
+                    res = hook(func, tries_remaining, e, sleep)
+                    if asyncio.iscoroutine(res):
+                        await res
+                    await asyncio.sleep(sleep)
+                    base = base * backoff
+                    last_sleep = sleep
+        return f2
+    return dec
+
+
+def catch_exception(hook=None, exceptions=(Exception,), log_exception=True, log_prefix=''):
+    """Coroutine version of functool.catch_exception, hook may be a plain
+    function or an async def function.
+
+    >>> @catch_exception(hook=lambda e: 'fallback', log_exception=False)
+    ... async def fail():
+    ...   raise ValueError()
+    >>> asyncio.run(fail())
+    'fallback'
+    """
+
+    def try_except(func):
+        _check_coroutine(func)
+
+        @functools.wraps(func)
+        async def f2(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except exceptions as e:
+                if log_exception:
+                    logging.exception('%s%s', log_prefix, _fmt_exception(e))
+                if not hook:
+                    raise
+                res = hook(e)
+                if asyncio.iscoroutine(res):
+                    res = await res
+                return res
+        return f2
+    return try_except
+
+
+def keep_run(delay):
+    """Coroutine version of functool.keep_run: catch the exception, wait
+    delay seconds without blocking the event loop, and rerun."""
+
+    def wrapper(func):
+        _check_coroutine(func)
+
+        @functools.wraps(func)
+        async def f2(*args, **kwargs):
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    logging.exception(_fmt_exception(e))
+                    if delay:
+                        await asyncio.sleep(delay)
+        return f2
+    return wrapper
+
+
+def rate_limit(limiter, key_func=None, blocking=True, timeout=None, max_keys=10000):
+    u"""
+    ratelimit.rate_limit的协程版, 等待时用asyncio.sleep, 参数相同.
+    limiter可以与同步代码共用.
+
+    >>> from ratelimit import TokenBucket
+    >>> @rate_limit(TokenBucket(rate=20, burst=1))
+    ... async def ping():
+    ...   return time.time()
+    >>> async def main():
+    ...   return await asyncio.gather(ping(), ping(), ping())
+    >>> times = asyncio.run(main())
+    >>> 0.09 < max(times) - min(times) < 0.2
+    True
+    """
+
+    keyed = KeyedRateLimiter(limiter, max_keys) if key_func else None
+
+    def dec(func):
+        _check_coroutine(func)
+
+        @functools.wraps(func)
+        async def limited(*args, **kwargs):
+            lim = limiter if keyed is None else keyed.get(key_func(*args, **kwargs))
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                wait = lim.try_acquire()
+                if not wait:
+                    break
+                if not blocking or (deadline is not None and time.time() + wait > deadline):
+                    raise RateLimited('%s rate limited' % func.__name__)
+                await asyncio.sleep(wait)
+            return await func(*args, **kwargs)
+        limited.limiter = limiter if keyed is None else keyed
+        return limited
+    return dec
@@ -0,0 +1,88 @@
+# coding: utf8
+"""
+asyncio版的KeyLock, 需要Python 3.7+ (asyncio.run)
+"""
+
+import asyncio
+
+
+class AsyncKeyLock(object):
+    """asyncio Lock类, 与lock.KeyLock的key语义相同, 等待时不阻塞event loop.
+    同一个key的lock在有协程持有或等待时一直保留, 之后自动释放.
+    只在一个event loop中使用.
+    @usage:
+    async with AsyncKeyLock('xxx'):
+        pass
+
+    >>> async def main():
+    ...     async with AsyncKeyLock('xxx'):
+    ...         waiter = asyncio.ensure_future(AsyncKeyLock('xxx').acquire())
+    ...         await asyncio.sleep(0)
+    ...         print(waiter.done(), AsyncKeyLock('xxx').locked(), len(AsyncKeyLock._LOCKS))
+    ...     await waiter
+    ...     AsyncKeyLock('xxx').release()
+    ...     print(len(AsyncKeyLock._LOCKS))
+    >>> asyncio.run(main())
+    False True 1
+    0
+    """
+
+    _LOCKS = {} # key -> [lock, 持有和等待的协程数]
+
+    def __init__(self, key):
+        self._key = key
+
+    def _new_lock(self):
+        return asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, _type, value, traceback):
+        self.release()
+
+    async def acquire(self):
+        entry = self._LOCKS.get(self._key)
+        if entry is None:
+            entry = self._LOCKS[self._key] = [self._new_lock(), 0]
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException: # 被cancel时也要释放引用
+            self._checkin()
+            raise
+        return True
+
+    def release(self):
+        entry = self._LOCKS.get(self._key)
+        if entry:
+            entry[0].release()
+            self._checkin()
+
+    def locked(self):
+        entry = self._LOCKS.get(self._key)
+        return entry is not None and entry[0].locked()
+
+    def _checkin(self):
+        entry = self._LOCKS[self._key]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._LOCKS[self._key]
+
+
+class AsyncKeySemaphore(AsyncKeyLock):
+    """同一个key最多value个协程同时持有, value在key的第一个使用者创建信号量时确定
+    @usage:
+    async with AsyncKeySemaphore('host', 3):
+        pass
+    """
+
+    _LOCKS = {}
+
+    def __init__(self, key, value=1):
+        AsyncKeyLock.__init__(self, key)
+        self._value = value
+
+    def _new_lock(self):
+        return asyncio.BoundedSemaphore(self._value)
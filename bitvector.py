@@ -1,6 +1,22 @@
 #! /bin/env python
+# coding=utf8
 
-import array
+import array, bisect, mmap, os, struct, threading
+from contextlib import contextmanager
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_WORD_MASK = (1 << 64) - 1
+_RANK_BLOCK_WORDS = 8 # rank index 每个block覆盖的word数
+
+if numpy is not None:
+    _BYTE_COUNTS = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+def _popcount(word):
+    return bin(word).count('1')
 
 class BitVector(object):
     def __init__(self, size, bits=None):
@@ -11,21 +27,540 @@ class BitVector(object):
         else:
             self.bits = array.array('L')
             self.bits.fromstring(bits)
+        self._rank_index = None
 
     def set_bit(self, i):
         if i < 0 or i >= self.size:
             return False
+        self._rank_index = None
         self.bits[i / self.item_size] |= (1 << (i % self.item_size))
         return True
 
+    def clear_bit(self, i):
+        if i < 0 or i >= self.size:
+            return False
+        self._rank_index = None
+        self.bits[i / self.item_size] &= ~(1 << (i % self.item_size)) & _WORD_MASK
+        return True
+
     def has_bit(self, i):
         if i < 0 or i >= self.size:
             return False
         return (self.bits[i / self.item_size] & (1 << (i % self.item_size))) != 0
 
+    def set_bits(self, indexes):
+        """set every index in indexes (iterable or numpy array), out of range
+        indexes are skipped. return the number of indexes applied.
+
+        >>> bv = BitVector(200)
+        >>> bv.set_bits([1, 64, 199, 200, -1])
+        3
+        >>> [bv.has_bit(i) for i in (0, 1, 64, 199)]
+        [False, True, True, True]
+        """
+        return self._bulk_update(indexes, True)
+
+    def clear_bits(self, indexes):
+        """clear every index in indexes, the opposite of set_bits
+
+        >>> bv = BitVector(200)
+        >>> bv.set_range(0, 200)
+        200
+        >>> bv.clear_bits(xrange(0, 200, 2))
+        100
+        >>> [bv.has_bit(i) for i in (0, 1, 198, 199)]
+        [False, True, False, True]
+        """
+        return self._bulk_update(indexes, False)
+
+    def has_bits(self, indexes):
+        """test every index in indexes. return a numpy bool array (list of
+        bool without numpy), out of range indexes are False.
+
+        >>> bv = BitVector(100)
+        >>> bv.set_bits([3, 70])
+        2
+        >>> list(bv.has_bits([3, 4, 70, 100, -3]))
+        [True, False, True, False, False]
+        """
+        if numpy is None:
+            return [self.has_bit(i) for i in indexes]
+        idx = self._index_array(indexes)
+        valid = (idx >= 0) & (idx < self.size)
+        result = numpy.zeros(len(idx), dtype=bool)
+        idx = idx[valid]
+        words = self._words()[idx / self.item_size]
+        shifts = (idx % self.item_size).astype(numpy.uint64)
+        result[valid] = (words >> shifts) & numpy.uint64(1) != 0
+        return result
+
+    def set_range(self, start, end):
+        """set bits in [start, end), clipped to the vector size.
+        return the number of bits in the range.
+
+        >>> bv = BitVector(300)
+        >>> bv.set_range(60, 260)
+        200
+        >>> [bv.has_bit(i) for i in (59, 60, 128, 259, 260)]
+        [False, True, True, True, False]
+        """
+        return self._range_update(start, end, True)
+
+    def clear_range(self, start, end):
+        """clear bits in [start, end), clipped to the vector size
+
+        >>> bv = BitVector(300)
+        >>> bv.set_range(0, 300)
+        300
+        >>> bv.clear_range(10, 20)
+        10
+        >>> [bv.has_bit(i) for i in (9, 10, 19, 20)]
+        [True, False, False, True]
+        """
+        return self._range_update(start, end, False)
+
+    def _words(self):
+        """numpy uint64 view sharing memory with self.bits (no copy)"""
+        return numpy.frombuffer(self.bits, dtype=numpy.uint64)
+
+    def _index_array(self, indexes):
+        if isinstance(indexes, numpy.ndarray):
+            return indexes.astype(numpy.int64, copy=False)
+        return numpy.fromiter(indexes, dtype=numpy.int64)
+
+    def _bulk_update(self, indexes, value):
+        self._rank_index = None
+        if numpy is None:
+            op = self.set_bit if value else self.clear_bit
+            return sum(1 for i in indexes if op(i))
+        idx = self._index_array(indexes)
+        idx = idx[(idx >= 0) & (idx < self.size)]
+        masks = numpy.left_shift(numpy.uint64(1), (idx % self.item_size).astype(numpy.uint64))
+        if value:
+            numpy.bitwise_or.at(self._words(), idx / self.item_size, masks)
+        else:
+            numpy.bitwise_and.at(self._words(), idx / self.item_size, ~masks)
+        return len(idx)
+
+    def _range_update(self, start, end, value):
+        start, end = max(start, 0), min(end, self.size)
+        if start >= end:
+            return 0
+        self._rank_index = None
+        first, last = start / self.item_size, (end - 1) / self.item_size
+        head = (_WORD_MASK << (start % self.item_size)) & _WORD_MASK
+        tail = _WORD_MASK >> (self.item_size - 1 - (end - 1) % self.item_size)
+        if first == last:
+            self._mask_word(first, head & tail, value)
+        else:
+            self._mask_word(first, head, value)
+            self._fill_words(first + 1, last, _WORD_MASK if value else 0)
+            self._mask_word(last, tail, value)
+        return end - start
+
+    def _mask_word(self, i, mask, value):
+        if value:
+            self.bits[i] |= mask
+        else:
+            self.bits[i] &= ~mask & _WORD_MASK
+
+    def _fill_words(self, start, end, word):
+        if start >= end:
+            return
+        if numpy is not None:
+            self._words()[start:end] = word
+        else:
+            self.bits[start:end] = array.array('L', [word]) * (end - start)
+
+    def count(self):
+        """number of set bits
+
+        >>> bv = BitVector(1000)
+        >>> bv.set_range(100, 400)
+        300
+        >>> bv.count()
+        300
+        """
+        if self._rank_index is not None:
+            return self._rank_index[-1]
+        if numpy is None:
+            return sum(_popcount(w) for w in self.bits)
+        return int(_BYTE_COUNTS[self._words().view(numpy.uint8)].sum(dtype=numpy.int64))
+
+    def build_rank_index(self):
+        """precompute set bit counts per block of words, so rank and select
+        become sub-linear. the index is dropped by any later modification
+        made through this object and rebuilt on demand by calling again.
+        """
+        counts = self._word_counts()
+        n = (len(counts) + _RANK_BLOCK_WORDS - 1) / _RANK_BLOCK_WORDS
+        if numpy is None:
+            index = [0] * (n + 1)
+            for i, c in enumerate(counts):
+                index[i / _RANK_BLOCK_WORDS + 1] += c
+            for i in xrange(n):
+                index[i + 1] += index[i]
+        else:
+            blocks = numpy.add.reduceat(counts, numpy.arange(0, len(counts), _RANK_BLOCK_WORDS))
+            index = [0] + numpy.cumsum(blocks).tolist()
+        self._rank_index = index
+
+    def rank(self, i):
+        """number of set bits before position i, i.e. in [0, i)
+
+        >>> bv = BitVector(2000)
+        >>> bv.set_bits(xrange(0, 2000, 3))
+        667
+        >>> bv.rank(0), bv.rank(1), bv.rank(1500), bv.rank(2000)
+        (0, 1, 500, 667)
+        >>> bv.build_rank_index()
+        >>> bv.rank(0), bv.rank(1), bv.rank(1500), bv.rank(2000)
+        (0, 1, 500, 667)
+        """
+        i = min(max(i, 0), self.size)
+        word, offset = i / self.item_size, i % self.item_size
+        if self._rank_index is not None:
+            block = word / _RANK_BLOCK_WORDS
+            start = block * _RANK_BLOCK_WORDS
+            result = self._rank_index[block] + sum(_popcount(w) for w in self.bits[start:word])
+        elif numpy is None:
+            result = sum(_popcount(w) for w in self.bits[:word])
+        else:
+            result = int(_BYTE_COUNTS[self._words()[:word].view(numpy.uint8)].sum(dtype=numpy.int64))
+        if offset:
+            result += _popcount(self.bits[word] & ((1 << offset) - 1))
+        return result
+
+    def select(self, k):
+        """position of the k-th (from 0) set bit, -1 if there are not
+        that many set bits
+
+        >>> bv = BitVector(2000)
+        >>> bv.set_bits(xrange(5, 2000, 7))
+        285
+        >>> bv.select(0), bv.select(100), bv.select(284), bv.select(285)
+        (5, 705, 1993, -1)
+        >>> bv.build_rank_index()
+        >>> bv.select(0), bv.select(100), bv.select(284), bv.select(285)
+        (5, 705, 1993, -1)
+        """
+        if k < 0:
+            return -1
+        if self._rank_index is not None:
+            index = self._rank_index
+            if k >= index[-1]:
+                return -1
+            block = bisect.bisect_right(index, k) - 1
+            word, k = block * _RANK_BLOCK_WORDS, k - index[block]
+        elif numpy is not None:
+            cum = numpy.cumsum(self._word_counts())
+            word = int(numpy.searchsorted(cum, k, side='right'))
+            if word >= len(cum):
+                return -1
+            k -= int(cum[word - 1]) if word else 0
+        else:
+            word = 0
+        while word < len(self.bits):
+            c = _popcount(self.bits[word])
+            if k < c:
+                break
+            k -= c
+            word += 1
+        else:
+            return -1
+        w = self.bits[word]
+        for offset in xrange(self.item_size):
+            if w & (1 << offset):
+                if k == 0:
+                    return word * self.item_size + offset
+                k -= 1
+
+    def indexes(self):
+        """sorted positions of the set bits, a list of int
+
+        >>> bv = BitVector(200)
+        >>> bv.set_bits([150, 3, 64])
+        3
+        >>> bv.indexes()
+        [3, 64, 150]
+        """
+        if numpy is None:
+            result = []
+            for word, w in enumerate(self.bits):
+                base = word * self.item_size
+                while w:
+                    low = w & -w
+                    result.append(base + low.bit_length() - 1)
+                    w ^= low
+            return result
+        bits = numpy.unpackbits(self._words().view(numpy.uint8).reshape(-1, 1), axis=1)[:, ::-1]
+        return numpy.flatnonzero(bits.ravel()).tolist()
+
+    def _word_counts(self):
+        if numpy is None:
+            return [_popcount(w) for w in self.bits]
+        return _BYTE_COUNTS[self._words().view(numpy.uint8)].reshape(-1, 8).sum(axis=1, dtype=numpy.int64)
+
+    def copy(self):
+        return BitVector(self.size, self.to_binary())
+
+    def __and__(self, other):
+        """
+        >>> a, b = BitVector(100), BitVector(100)
+        >>> a.set_range(0, 60), b.set_range(40, 100)
+        (60, 60)
+        >>> (a & b).count(), (a | b).count(), (a ^ b).count(), (~a).count()
+        (20, 100, 80, 40)
+        >>> a &= b
+        >>> a.count()
+        20
+        """
+        return self.copy().__iand__(other)
+
+    def __or__(self, other):
+        return self.copy().__ior__(other)
+
+    def __xor__(self, other):
+        return self.copy().__ixor__(other)
+
+    def __invert__(self):
+        result = self.copy()
+        if numpy is None:
+            result.bits = array.array('L', (~w & _WORD_MASK for w in result.bits))
+        else:
+            words = result._words()
+            numpy.invert(words, out=words)
+        result._clear_tail()
+        return result
+
+    def __iand__(self, other):
+        return self._inplace_op(other, 'bitwise_and', lambda x, y: x & y)
+
+    def __ior__(self, other):
+        return self._inplace_op(other, 'bitwise_or', lambda x, y: x | y)
+
+    def __ixor__(self, other):
+        return self._inplace_op(other, 'bitwise_xor', lambda x, y: x ^ y)
+
+    def _inplace_op(self, other, ufunc, op):
+        if self.size != other.size:
+            raise ValueError('BitVector size mismatch: %d != %d' % (self.size, other.size))
+        self._rank_index = None
+        if numpy is None:
+            self.bits[:] = array.array('L', map(op, self.bits, other.bits))
+        else:
+            words = self._words()
+            getattr(numpy, ufunc)(words, other._words(), out=words)
+        return self
+
+    def _clear_tail(self):
+        """zero the bits past self.size in the last words"""
+        last = self.size / self.item_size
+        if last < len(self.bits):
+            self.bits[last] &= (1 << (self.size % self.item_size)) - 1
+            self._fill_words(last + 1, len(self.bits), 0)
+
     def size(self):
         return len(self.bits.tostring())
 
     def to_binary(self):
         return self.bits.tostring()
 
+    def save(self, path):
+        """write the to_binary() layout to path without building a string,
+        the file can be opened again by MappedBitVector"""
+        with open(path, 'wb') as fout:
+            self.bits.tofile(fout)
+
+
+class ConcurrentBitVector(BitVector):
+    """BitVector that many threads can modify at once without losing updates.
+
+    the read-modify-write of a word is guarded by one of stripes locks,
+    word i by lock i % stripes, so threads setting bits in different words
+    seldom wait for each other. has_bit reads a single word and takes no
+    lock. bulk, range and set algebra updates take every stripe.
+
+    >>> bv = ConcurrentBitVector(1000, stripes=8)
+    >>> bv.set_bit(3), bv.set_range(10, 20), bv.set_bits([500, 600])
+    (True, 10, 2)
+    >>> bv.count()
+    13
+    """
+
+    def __init__(self, size, bits=None, stripes=64):
+        BitVector.__init__(self, size, bits)
+        self._locks = [threading.Lock() for _ in xrange(stripes)]
+
+    def set_bit(self, i):
+        if i < 0 or i >= self.size:
+            return False
+        self._rank_index = None
+        word = i / self.item_size
+        with self._locks[word % len(self._locks)]:
+            self.bits[word] |= (1 << (i % self.item_size))
+        return True
+
+    def clear_bit(self, i):
+        if i < 0 or i >= self.size:
+            return False
+        self._rank_index = None
+        word = i / self.item_size
+        with self._locks[word % len(self._locks)]:
+            self.bits[word] &= ~(1 << (i % self.item_size)) & _WORD_MASK
+        return True
+
+    @contextmanager
+    def _all_locks(self):
+        # 按固定顺序加锁, 避免死锁
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self._locks):
+                lock.release()
+
+    def _bulk_update(self, indexes, value):
+        if numpy is None: # falls back to set_bit/clear_bit, locked per word
+            return BitVector._bulk_update(self, indexes, value)
+        with self._all_locks():
+            return BitVector._bulk_update(self, indexes, value)
+
+    def _range_update(self, start, end, value):
+        with self._all_locks():
+            return BitVector._range_update(self, start, end, value)
+
+    def _inplace_op(self, other, ufunc, op):
+        with self._all_locks():
+            return BitVector._inplace_op(self, other, ufunc, op)
+
+
+class _MappedWords(object):
+    """array('L') like word access over a mmap"""
+
+    _WORD = struct.Struct('L')
+
+    def __init__(self, buf, length):
+        self.buf = buf
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        unpack_from, buf = self._WORD.unpack_from, self.buf
+        for offset in xrange(0, self.length * self._WORD.size, self._WORD.size):
+            yield unpack_from(buf, offset)[0]
+
+    def _byte_range(self, s):
+        start, stop, step = s.indices(self.length)
+        if step != 1:
+            raise ValueError('extended slice is not supported')
+        return start * self._WORD.size, max(start, stop) * self._WORD.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop = self._byte_range(i)
+            words = array.array('L')
+            words.fromstring(self.buf[start:stop])
+            return words
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError('word index out of range')
+        return self._WORD.unpack_from(self.buf, i * self._WORD.size)[0]
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            start, stop = self._byte_range(i)
+            data = value.tostring()
+            if len(data) != stop - start:
+                raise ValueError('can not resize a mapped word array')
+            self.buf[start:stop] = data
+            return
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError('word index out of range')
+        self._WORD.pack_into(self.buf, i * self._WORD.size, value)
+
+    def tostring(self):
+        return self.buf[:self.length * self._WORD.size]
+
+
+class MappedBitVector(BitVector):
+    """BitVector whose words live in a mmap'd file with the to_binary() layout.
+
+    opening is O(1), pages are loaded lazily by the OS, and the mapping is
+    shared, so several processes can open the same file without copying.
+    set_bit and the other modifications write through to the mapping,
+    call flush() to force them to disk.
+
+    size - number of bits, default is everything the file can hold.
+           a writable file shorter than size is extended with zero bits.
+    readonly - map the file read only, modifications raise an error
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp()
+    >>> with MappedBitVector(path, 1000) as bv:
+    ...     bv.set_bit(10), bv.set_range(500, 600)
+    (True, 100)
+    >>> with MappedBitVector(path, readonly=True) as bv:
+    ...     bv.has_bit(10), bv.has_bit(11), bv.count()
+    (True, False, 101)
+    >>> BitVector(1000, open(path, 'rb').read()).count()
+    101
+    >>> os.remove(path)
+    """
+
+    def __init__(self, path, size=None, readonly=False):
+        self.path = path
+        self.item_size = 64
+        self.readonly = readonly
+        word_size = _MappedWords._WORD.size
+        fd = os.open(path, os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT)
+        try:
+            file_words = os.fstat(fd).st_size / word_size
+            if size is None:
+                size, words = file_words * self.item_size, file_words
+            else:
+                words = size / self.item_size + 1
+            if words > file_words:
+                if readonly:
+                    raise ValueError('%s holds %d words, less than %d' % (path, file_words, words))
+                os.ftruncate(fd, words * word_size)
+            if readonly:
+                self._mmap = mmap.mmap(fd, words * word_size, access=mmap.ACCESS_READ)
+            else:
+                self._mmap = mmap.mmap(fd, words * word_size)
+        finally:
+            os.close(fd)
+        self.size = size
+        self.bits = _MappedWords(self._mmap, words)
+        self._rank_index = None
+
+    def _words(self):
+        return numpy.frombuffer(self._mmap, dtype=numpy.uint64, count=len(self.bits))
+
+    def flush(self):
+        if not self.readonly:
+            self._mmap.flush()
+
+    def close(self):
+        """flush and unmap, the object can not be used afterwards"""
+        if self._mmap is None:
+            return
+        self.flush()
+        self._mmap.close()
+        self._mmap = None
+
+    def save(self, path):
+        with open(path, 'wb') as fout:
+            fout.write(self._mmap[:])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self.close()
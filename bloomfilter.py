@@ -0,0 +1,203 @@
+#! /bin/env python
+# coding=utf8
+"""
+Bloom filter, 基于bitvector.BitVector
+"""
+
+import hashlib, math, struct
+
+from bitvector import BitVector, MappedBitVector, _WORD_MASK
+from pyutil import unicode_to_str
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _hash_pair(key):
+    """two 64 bit hashes of key, positions are derived by double hashing"""
+    return struct.unpack('<QQ', hashlib.md5(unicode_to_str(key)).digest())
+
+
+class BloomFilter(object):
+    """
+    capacity - expected number of items
+    error_rate - target false positive rate when capacity items are added
+    bits - binary from to_binary(), to load a saved filter
+    path - keep the bits in a mmap'd file (see bitvector.MappedBitVector),
+           a filter saved by save() can be opened this way
+    readonly - open path read only
+
+    the filter layout only depends on capacity and error_rate, so the same
+    arguments must be used to load a saved filter.
+
+    >>> bf = BloomFilter(1000, 0.01)
+    >>> bf.num_bits, bf.num_hashes
+    (9586, 7)
+    >>> bf.add('http://a.com/1')
+    False
+    >>> bf.add('http://a.com/1')
+    True
+    >>> bf.add_many(['http://a.com/2', u'http://a.com/3'])
+    >>> 'http://a.com/2' in bf, 'http://a.com/4' in bf
+    (True, False)
+    >>> list(bf.contains_many(['http://a.com/3', 'http://a.com/5']))
+    [True, False]
+    >>> 'http://a.com/3' in BloomFilter(1000, 0.01, bits=bf.to_binary())
+    True
+    """
+
+    def __init__(self, capacity, error_rate=0.001, bits=None, path=None, readonly=False):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError('invalid capacity %r or error_rate %r' % (capacity, error_rate))
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(float(self.num_bits) / capacity * math.log(2))))
+        self.bits = self._make_bits(self.num_bits, bits, path, readonly)
+
+    def _make_bits(self, size, bits, path, readonly):
+        if path is not None:
+            return MappedBitVector(path, size, readonly=readonly)
+        return BitVector(size, bits)
+
+    def _positions(self, key):
+        h1, h2 = _hash_pair(key)
+        return [((h1 + i * h2) & _WORD_MASK) % self.num_bits for i in xrange(self.num_hashes)]
+
+    def _positions_many(self, keys):
+        """numpy array of shape (len(keys), num_hashes)"""
+        hashes = numpy.array([_hash_pair(key) for key in keys], dtype=numpy.uint64).reshape(-1, 2)
+        steps = numpy.arange(self.num_hashes, dtype=numpy.uint64)
+        positions = hashes[:, :1] + steps * hashes[:, 1:]
+        return (positions % numpy.uint64(self.num_bits)).astype(numpy.int64)
+
+    def add(self, key):
+        """add key, return True if key was (probably) already in the filter"""
+        present = True
+        for i in self._positions(key):
+            if not self.bits.has_bit(i):
+                present = False
+                self.bits.set_bit(i)
+        return present
+
+    def add_many(self, keys):
+        if numpy is None:
+            for key in keys:
+                self.add(key)
+        else:
+            self.bits.set_bits(self._positions_many(list(keys)).ravel())
+
+    def __contains__(self, key):
+        for i in self._positions(key):
+            if not self.bits.has_bit(i):
+                return False
+        return True
+
+    def contains_many(self, keys):
+        """numpy bool array (list of bool without numpy)"""
+        if numpy is None:
+            return [key in self for key in keys]
+        positions = self._positions_many(list(keys))
+        return self.bits.has_bits(positions.ravel()).reshape(positions.shape).all(axis=1)
+
+    def to_binary(self):
+        return self.bits.to_binary()
+
+    def save(self, path):
+        self.bits.save(path)
+
+    def flush(self):
+        if isinstance(self.bits, MappedBitVector):
+            self.bits.flush()
+
+    def close(self):
+        if isinstance(self.bits, MappedBitVector):
+            self.bits.close()
+
+
+class CountingBloomFilter(BloomFilter):
+    """Bloom filter with 4 bit counters, supports remove.
+
+    counters are packed 16 per word in a BitVector, so to_binary, save and
+    path work the same as BloomFilter. a counter that reaches 15 sticks
+    there and is never decremented, to avoid false negatives.
+
+    >>> cbf = CountingBloomFilter(1000, 0.01)
+    >>> cbf.add_many(['a', 'b', 'b'])
+    >>> cbf.remove('b'), 'b' in cbf
+    (True, True)
+    >>> cbf.remove('b'), 'b' in cbf, 'a' in cbf
+    (True, False, True)
+    >>> cbf.remove('c')
+    False
+    """
+
+    COUNTER_BITS = 4
+    COUNTER_MAX = (1 << COUNTER_BITS) - 1
+    COUNTERS_PER_WORD = 64 / COUNTER_BITS
+
+    def _make_bits(self, size, bits, path, readonly):
+        return BloomFilter._make_bits(self, size * self.COUNTER_BITS, bits, path, readonly)
+
+    def _get(self, i):
+        shift = i % self.COUNTERS_PER_WORD * self.COUNTER_BITS
+        return (self.bits.bits[i / self.COUNTERS_PER_WORD] >> shift) & self.COUNTER_MAX
+
+    def _set(self, i, value):
+        words = self.bits.bits
+        shift = i % self.COUNTERS_PER_WORD * self.COUNTER_BITS
+        w = i / self.COUNTERS_PER_WORD
+        words[w] = (words[w] & ~(self.COUNTER_MAX << shift) & _WORD_MASK) | (value << shift)
+
+    def add(self, key):
+        present = True
+        for i in self._positions(key):
+            count = self._get(i)
+            if count == 0:
+                present = False
+            if count < self.COUNTER_MAX:
+                self._set(i, count + 1)
+        return present
+
+    def add_many(self, keys):
+        if numpy is None:
+            for key in keys:
+                self.add(key)
+            return
+        slots, increments = numpy.unique(self._positions_many(list(keys)), return_counts=True)
+        words = self.bits._words()
+        index = slots / self.COUNTERS_PER_WORD
+        shifts = (slots % self.COUNTERS_PER_WORD * self.COUNTER_BITS).astype(numpy.uint64)
+        mask = numpy.uint64(self.COUNTER_MAX)
+        counts = (words[index] >> shifts) & mask
+        counts = numpy.minimum(counts + increments.astype(numpy.uint64), mask)
+        numpy.bitwise_and.at(words, index, ~(mask << shifts))
+        numpy.bitwise_or.at(words, index, counts << shifts)
+
+    def remove(self, key):
+        """remove key, return False if key is not in the filter"""
+        positions = self._positions(key)
+        counts = [self._get(i) for i in positions]
+        if not all(counts):
+            return False
+        for i, count in zip(positions, counts):
+            if count < self.COUNTER_MAX:
+                self._set(i, count - 1)
+        return True
+
+    def __contains__(self, key):
+        for i in self._positions(key):
+            if not self._get(i):
+                return False
+        return True
+
+    def contains_many(self, keys):
+        if numpy is None:
+            return [key in self for key in keys]
+        positions = self._positions_many(list(keys))
+        slots = positions.ravel()
+        shifts = (slots % self.COUNTERS_PER_WORD * self.COUNTER_BITS).astype(numpy.uint64)
+        counts = (self.bits._words()[slots / self.COUNTERS_PER_WORD] >> shifts) & numpy.uint64(self.COUNTER_MAX)
+        return (counts != 0).reshape(positions.shape).all(axis=1)
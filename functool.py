@@ -1,9 +1,34 @@
 #coding=utf8
 
-import functools, time, sys, logging
+import functools, time, sys, logging, threading, random
+from collections import OrderedDict
 from fmtutil import fmt_exception
+from pyutil import make_hash
 
-def throttle(wait, exception_wait=0):
+_KWD_MARK = object() # separates args from kwargs in a key, like functools._make_key
+
+
+def _make_key(args, kwargs):
+    """cache key of a call, falls back to pyutil.make_hash for unhashable args"""
+    key = args + (_KWD_MARK,) + tuple(sorted(kwargs.items())) if kwargs else args
+    try:
+        hash(key)
+    except TypeError:
+        key = make_hash([args, kwargs])
+    return key
+
+
+class _ThrottleEntry(object):
+    __slots__ = ('cache_at', 'value', 'has_value', 'ready')
+
+    def __init__(self):
+        self.cache_at = None # 计算开始的时间 (非计算完成时间, 以减少多线程环境下计算被重复进行的概率)
+        self.value = None
+        self.has_value = False
+        self.ready = threading.Event() # 第一次计算完成(或失败)时set
+
+
+def throttle(wait, exception_wait=0, keyed=False, max_keys=1000, key_func=None):
     u"""
     在指定时间间隔内, 只调用一次的decorator. 如果在时间间隔内第二次调用, 则返回上一次调用的结果.
     可作用于任何函数和方法.
@@ -12,6 +37,11 @@ def throttle(wait, exception_wait=0):
 
     wait - in ms. 两次调用的间隔时间
     exception_wait - in ms. 发生异常时下次调用的间隔. 0表示下次调用无需间隔
+    keyed - 为True时按参数分别缓存, 不同参数的调用互不影响
+    max_keys - keyed时最多缓存的参数组数, 超过时淘汰最久未用的
+    key_func - keyed时由key_func(*args, **kwargs)计算缓存的key, 默认用全部参数
+
+    第一次计算未完成时, 其他调用等待计算完成(不轮询), 计算完成后立即返回.
 
     >>> @throttle(wait=1000) # load_urls 1秒内只会被调用一次
     ... def load_urls():
@@ -26,40 +56,493 @@ def throttle(wait, exception_wait=0):
     >>> load_urls() # 1秒之后再调用, 执行
     loaded
     'ok'
+
+    >>> @throttle(wait=1000, keyed=True, max_keys=2)
+    ... def load_url(url):
+    ...   print 'load', url
+    ...   return url.upper()
+    >>> load_url('a'), load_url('b'), load_url('a')
+    load a
+    load b
+    ('A', 'B', 'A')
+    >>> load_url('c'), load_url('a') # 'b' 最久未用, 被淘汰
+    load c
+    ('C', 'A')
+    >>> load_url('b')
+    load b
+    'B'
+
+    >>> throttled = throttle(wait=10000, keyed=True) # 同一个decorator装饰的函数各自缓存
+    >>> a, b = throttled(lambda x: 'a%s' % x), throttled(lambda x: 'b%s' % x)
+    >>> a(1), b(1)
+    ('a1', 'b1')
     """
 
     wait = wait / 1000.0
     exception_wait = exception_wait / 1000.0
-
-    ns = dict(
-            cache_at = None, # 计算开始的时间 (非计算完成时间, 以减少多线程环境下计算被重复进行的概率)
-            )
+    max_keys = max_keys if keyed else 1
 
     def wrapper(f):
+        lock = threading.Lock()
+        entries = OrderedDict() # key -> _ThrottleEntry, 按最近使用排序, 每个函数各自一份
+
         @functools.wraps(f)
         def throttled(*args, **kwargs):
-            cache_at = ns['cache_at']
-            if cache_at and time.time() - cache_at < wait:
-                while True: # 获取计算结果并返回
-                    if 'cached_value' in ns:
-                        return ns['cached_value']
-                    time.sleep(.1)
-
-            ns['cache_at'] = time.time()
+            if not keyed:
+                key = None
+            elif key_func:
+                key = key_func(*args, **kwargs)
+            else:
+                key = _make_key(args, kwargs)
+            with lock:
+                entry = entries.pop(key, None)
+                if entry is None:
+                    entry = _ThrottleEntry()
+                entries[key] = entry
+                if len(entries) > max_keys:
+                    entries.popitem(last=False)
+                now = time.time()
+                fresh = entry.cache_at and now - entry.cache_at < wait
+                if not fresh:
+                    entry.cache_at = now
+            if fresh: # 获取计算结果并返回
+                if not entry.has_value:
+                    entry.ready.wait()
+                return entry.value
+
             try:
-                ns['cached_value'] = f(*args, **kwargs)
+                value = f(*args, **kwargs)
             except:
-                if 'cached_value' not in ns:
-                    ns['cached_value'] = None # 赋值以避免其他线程的计算一直等待结果
-                ns['cached_at'] = time.time() - wait + exception_wait
+                with lock:
+                    if not entry.has_value: # 赋值以避免其他线程的计算一直等待结果
+                        entry.value, entry.has_value = None, True
+                    entry.cache_at = time.time() - wait + exception_wait
+                entry.ready.set()
                 raise
-            return ns['cached_value']
+            entry.value, entry.has_value = value, True
+            entry.ready.set()
+            return value
         return throttled
 
     return wrapper
 
 
-def retries(max_tries, delay=1, backoff=2, exceptions=(Exception,), ignore_exceptions=None, hook=None):
+class _CacheShard(object):
+    __slots__ = ('lock', 'entries', 'nbytes', 'hits', 'misses', 'evictions', 'expirations')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (expire_at, value, exception, size), 按最近使用排序
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+
+def memoize(ttl=None, max_entries=1024, max_bytes=None, sizeof=sys.getsizeof,
+        cache_exceptions=(), exception_ttl=None, key_func=None, shards=16):
+    u"""
+    缓存函数结果的decorator, 按参数缓存, LRU淘汰, 可作用于任何函数和方法(self也是key的一部分).
+
+    ttl - in seconds. 结果的有效期, None表示不过期
+    max_entries - 最多缓存的结果数, None表示不限(只用max_bytes限制)
+    max_bytes - 结果总大小的上限(近似值, 由sizeof计算), None表示不限
+    sizeof - 计算结果大小的函数, 默认sys.getsizeof (不含引用的对象)
+    cache_exceptions - 需要缓存的异常类(tuple), 有效期内再次调用直接抛出同一个异常
+    exception_ttl - in seconds. 异常的有效期, 默认同ttl
+    key_func - 由key_func(*args, **kwargs)计算缓存的key, 默认用全部参数
+
+    缓存按key的hash分成shards份, 各有自己的锁和LRU, 命中时不会争用同一把锁;
+    max_entries和max_bytes平均分到各份, 所以LRU是近似的.
+    同一个key同时未命中时会重复计算, 需要时配合single_flight使用.
+    被装饰的函数有cache_info()和cache_clear()方法.
+
+    >>> @memoize(ttl=0.2, cache_exceptions=(KeyError,))
+    ... def lookup(name):
+    ...   print 'lookup', name
+    ...   return {'a': 1}[name]
+    >>> lookup('a'), lookup('a')
+    lookup a
+    (1, 1)
+    >>> for _ in range(2):
+    ...   try:
+    ...     lookup('b')
+    ...   except KeyError, e:
+    ...     print 'KeyError', e
+    lookup b
+    KeyError 'b'
+    KeyError 'b'
+    >>> time.sleep(0.2)
+    >>> lookup('a')
+    lookup a
+    1
+    >>> info = lookup.cache_info()
+    >>> info['hits'], info['misses'], info['expirations'], info['entries']
+    (2, 3, 1, 2)
+
+    >>> class Page(object):
+    ...   def __init__(self, n):
+    ...     self.n = n
+    ...   @memoize(max_entries=1, shards=1)
+    ...   def render(self):
+    ...     print 'render', self.n
+    ...     return self.n
+    >>> p1, p2 = Page(1), Page(2)
+    >>> p1.render(), p1.render(), p2.render(), p1.render()
+    render 1
+    render 2
+    render 1
+    (1, 1, 2, 1)
+    >>> Page.render.cache_info()['evictions']
+    2
+
+    >>> @memoize(max_entries=None, max_bytes=8, sizeof=len, shards=1) # 只限制大小
+    ... def read(name):
+    ...   return name * 4
+    >>> read('a'), read('b'), read('c'), read.cache_info()['entries']
+    ('aaaa', 'bbbb', 'cccc', 2)
+
+    >>> cached = memoize(ttl=60) # 同一个decorator装饰的函数各自缓存
+    >>> a, b = cached(lambda x: 'a%s' % x), cached(lambda x: 'b%s' % x)
+    >>> a(1), b(1)
+    ('a1', 'b1')
+
+    >>> @memoize() # 位置参数和关键字参数不会拼成相同的key
+    ... def call(*args, **kwargs):
+    ...   return args, kwargs
+    >>> call((1,), (('a', 2),)), call(1, a=2)
+    ((((1,), (('a', 2),)), {}), ((1,), {'a': 2}))
+    """
+
+    if max_entries is not None:
+        shards = max(min(shards, max_entries), 1)
+    shard_entries = None if max_entries is None else -(-max_entries // shards)
+    shard_bytes = max_bytes and -(-max_bytes // shards)
+    if exception_ttl is None:
+        exception_ttl = ttl
+
+    def store(shard, key, item):
+        with shard.lock:
+            old = shard.entries.pop(key, None)
+            if old is not None:
+                shard.nbytes -= old[3]
+            shard.entries[key] = item
+            shard.nbytes += item[3]
+            while shard.entries and ((shard_entries is not None and len(shard.entries) > shard_entries) or
+                    (shard_bytes and shard.nbytes > shard_bytes)):
+                shard.nbytes -= shard.entries.popitem(last=False)[1][3]
+                shard.evictions += 1
+
+    def wrapper(f):
+        caches = [_CacheShard() for _ in xrange(shards)] # 每个函数有自己的缓存
+
+        @functools.wraps(f)
+        def memoized(*args, **kwargs):
+            key = key_func(*args, **kwargs) if key_func else _make_key(args, kwargs)
+            shard = caches[hash(key) % shards]
+            now = time.time()
+            with shard.lock:
+                item = shard.entries.pop(key, None)
+                if item is not None:
+                    if item[0] is None or item[0] > now:
+                        shard.entries[key] = item
+                        shard.hits += 1
+                    else:
+                        shard.nbytes -= item[3]
+                        shard.expirations += 1
+                        item = None
+                if item is None:
+                    shard.misses += 1
+            if item is not None:
+                if item[2] is not None:
+                    raise item[2]
+                return item[1]
+
+            try:
+                value = f(*args, **kwargs)
+            except cache_exceptions, e:
+                expire_at = None if exception_ttl is None else time.time() + exception_ttl
+                store(shard, key, (expire_at, None, e, sizeof(e)))
+                raise
+            expire_at = None if ttl is None else time.time() + ttl
+            store(shard, key, (expire_at, value, None, sizeof(value)))
+            return value
+
+        def cache_info():
+            info = dict(hits=0, misses=0, evictions=0, expirations=0, entries=0, bytes=0)
+            for shard in caches:
+                with shard.lock:
+                    info['hits'] += shard.hits
+                    info['misses'] += shard.misses
+                    info['evictions'] += shard.evictions
+                    info['expirations'] += shard.expirations
+                    info['entries'] += len(shard.entries)
+                    info['bytes'] += shard.nbytes
+            return info
+
+        def cache_clear():
+            for shard in caches:
+                with shard.lock:
+                    shard.entries.clear()
+                    shard.nbytes = 0
+
+        memoized.cache_info = cache_info
+        memoized.cache_clear = cache_clear
+        return memoized
+
+    return wrapper
+
+
+class SingleFlightTimeout(Exception):
+    pass
+
+
+class _Flight(object):
+    __slots__ = ('started_at', 'done', 'value', 'exc_info')
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+
+def single_flight(key_func=None, timeout=None):
+    u"""
+    合并并发调用的decorator: 参数相同的调用同时进行时只执行一次, 其他调用等待并得到同一个结果或异常.
+    不缓存结果, 执行结束后的调用会重新执行. 可作用于任何函数和方法.
+
+    key_func - 由key_func(*args, **kwargs)计算key, 默认用全部参数(不可hash时用pyutil.make_hash)
+    timeout - in seconds. 等待的调用最多等待的时间, 超时抛出SingleFlightTimeout;
+        执行超过timeout后, 新的调用不再等待这次执行, 而是重新执行
+
+    >>> calls = []
+    >>> @single_flight()
+    ... def load(key):
+    ...   calls.append(key)
+    ...   time.sleep(0.1)
+    ...   return key * 2
+    >>> results = []
+    >>> threads = [threading.Thread(target=lambda: results.append(load(21))) for _ in range(5)]
+    >>> for t in threads: t.start()
+    >>> for t in threads: t.join()
+    >>> calls, results
+    ([21], [42, 42, 42, 42, 42])
+
+    >>> coalesce = single_flight() # 同一个decorator装饰的函数互不合并
+    >>> slow_a = coalesce(lambda x: time.sleep(0.1) or 'A')
+    >>> slow_b = coalesce(lambda x: 'B')
+    >>> t = threading.Thread(target=slow_a, args=(1,)); t.start()
+    >>> slow_b(1)
+    'B'
+    >>> t.join()
+    """
+
+    def wrapper(f):
+        lock = threading.Lock()
+        flights = {} # key -> 正在执行的_Flight, 每个函数各自一份
+
+        @functools.wraps(f)
+        def coalesced(*args, **kwargs):
+            key = key_func(*args, **kwargs) if key_func else _make_key(args, kwargs)
+            now = time.time()
+            with lock:
+                flight = flights.get(key)
+                leader = flight is None or (timeout is not None and now - flight.started_at >= timeout)
+                if leader:
+                    flight = flights[key] = _Flight()
+            if not leader:
+                remaining = None if timeout is None else flight.started_at + timeout - now
+                if not flight.done.wait(remaining):
+                    raise SingleFlightTimeout('%s%r still running after %ss' % (f.__name__, args, timeout))
+                if flight.exc_info:
+                    raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+                return flight.value
+
+            try:
+                flight.value = f(*args, **kwargs)
+            except:
+                flight.exc_info = sys.exc_info()
+                raise
+            finally:
+                with lock:
+                    if flights.get(key) is flight:
+                        del flights[key]
+                flight.done.set()
+            return flight.value
+        return coalesced
+
+    return wrapper
+
+
+class _RefreshEntry(object):
+    __slots__ = ('value', 'fetched_at', 'loading', 'failed', 'exc_info', 'loads')
+
+    def __init__(self):
+        self.value = None
+        self.fetched_at = None # 值计算完成的时间, None表示还没有值
+        self.loading = False
+        self.failed = False # 最近一次计算失败
+        self.exc_info = None
+        self.loads = 0 # 完成的计算次数, 等待者据此判断计算是否结束
+
+
+def refresh_ahead(soft_ttl, hard_ttl, pool=None, grace=0, max_keys=1000, key_func=None):
+    u"""
+    stale-while-revalidate方式按参数缓存结果的decorator, 可作用于任何函数和方法.
+
+    soft_ttl - in seconds. 超过soft_ttl后, 调用直接返回旧值, 同时在后台刷新(同一个key只有一个刷新)
+    hard_ttl - in seconds. 超过hard_ttl后, 调用阻塞等待重新计算(同一个key只计算一次, 其他调用等待)
+    pool - 后台刷新所用的thread.ThreadPool (或任何有queue_task(task, args)的对象),
+        None表示每次刷新启动一个线程
+    grace - in seconds. 计算失败后, 旧值在hard_ttl之后还可以再用grace秒, 期间继续在后台重试
+    max_keys - 最多缓存的参数组数, 超过时淘汰最久未用的
+    key_func - 由key_func(*args, **kwargs)计算缓存的key, 默认用全部参数
+
+    >>> version = [0]
+    >>> @refresh_ahead(soft_ttl=0.1, hard_ttl=10)
+    ... def load_config():
+    ...   version[0] += 1
+    ...   return version[0]
+    >>> load_config(), load_config()
+    (1, 1)
+    >>> time.sleep(0.1)
+    >>> load_config() # 过了soft_ttl, 返回旧值, 后台刷新
+    1
+    >>> time.sleep(0.05)
+    >>> load_config()
+    2
+    """
+
+    def wrapper(f):
+        cond = threading.Condition(threading.Lock())
+        entries = OrderedDict() # key -> _RefreshEntry, 按最近使用排序, 每个函数各自一份
+
+        def load(entry, args, kwargs):
+            """run f and keep its result, return sys.exc_info() if it failed"""
+            ok, exc_info = False, None
+            try:
+                value = f(*args, **kwargs)
+                ok = True
+            except Exception:
+                exc_info = sys.exc_info()
+            finally: # 无论如何结束loading, 否则等待者永远等下去
+                with cond:
+                    if ok:
+                        entry.value, entry.fetched_at = value, time.time()
+                        entry.failed, entry.exc_info = False, None
+                    elif exc_info:
+                        entry.failed, entry.exc_info = True, exc_info
+                    entry.loading = False
+                    entry.loads += 1
+                    cond.notify_all()
+            return exc_info
+
+        def refresh(entry, args, kwargs):
+            exc_info = load(entry, args, kwargs)
+            if exc_info:
+                logging.warn('refresh %s failed, keep the stale value: %s', f.__name__, fmt_exception(exc_info[1]))
+
+        def start_refresh(entry, args, kwargs):
+            started = False
+            try:
+                if pool is not None:
+                    try:
+                        started = pool.queue_task(refresh, (entry, args, kwargs))
+                    except Exception, e: # 如队列满时的Full
+                        logging.exception(e)
+                    if not started:
+                        logging.warn('refresh %s not queued, refresh in a new thread', f.__name__)
+                if not started:
+                    t = threading.Thread(target=refresh, args=(entry, args, kwargs))
+                    t.setDaemon(True)
+                    t.start()
+                    started = True
+            finally:
+                if not started:
+                    with cond:
+                        entry.loading = False
+                        cond.notify_all()
+
+        @functools.wraps(f)
+        def refreshed(*args, **kwargs):
+            key = key_func(*args, **kwargs) if key_func else _make_key(args, kwargs)
+            with cond:
+                entry = entries.pop(key, None)
+                if entry is None:
+                    entry = _RefreshEntry()
+                entries[key] = entry
+                if len(entries) > max_keys:
+                    entries.popitem(last=False)
+                loads = None # 开始等待时的loads
+                sync = False
+                while True:
+                    age = None if entry.fetched_at is None else time.time() - entry.fetched_at
+                    if age is not None and (age < hard_ttl or (entry.failed and age < hard_ttl + grace)):
+                        background = age >= soft_ttl and not entry.loading
+                        entry.loading = entry.loading or background
+                        value = entry.value
+                        break
+                    if loads is not None and entry.loads != loads and entry.exc_info:
+                        exc_info = entry.exc_info # 等待的计算失败了
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    if not entry.loading:
+                        entry.loading = sync = True
+                        break
+                    loads = entry.loads
+                    cond.wait()
+
+            if not sync:
+                if background:
+                    start_refresh(entry, args, kwargs)
+                return value
+            exc_info = load(entry, args, kwargs)
+            if exc_info:
+                with cond:
+                    age = None if entry.fetched_at is None else time.time() - entry.fetched_at
+                    if age is not None and age < hard_ttl + grace:
+                        logging.warn('load %s failed, use the stale value: %s', f.__name__, fmt_exception(exc_info[1]))
+                        return entry.value
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return entry.value
+        return refreshed
+
+    return wrapper
+
+
+class RetryBudget(object):
+    """Token bucket shared by the calls of one or more retries decorated
+    functions, so retries stay a fraction of the calls while a dependency
+    is failing.
+
+    Every call deposits ratio tokens, every retry takes one token, at most
+    max_tokens are kept. With no token left the call fails without retrying.
+
+    >>> budget = RetryBudget(ratio=0.5, max_tokens=1)
+    >>> budget.deposit(); budget.withdraw(), budget.withdraw()
+    (True, False)
+    >>> budget.deposit(); budget.deposit(); budget.withdraw()
+    True
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def retries(max_tries, delay=1, backoff=2, exceptions=(Exception,), ignore_exceptions=None, hook=None,
+        jitter=None, max_delay=None, max_elapsed=None, budget=None):
     """Function decorator implementing retrying logic.
 
     delay: Sleep this many seconds * backoff^try number after failure
@@ -68,6 +551,15 @@ def retries(max_tries, delay=1, backoff=2, exceptions=(Exception,), ignore_excep
     ignore_exceptions: A tuple of exception classes to not catch; default None
     hook: A function with the signature myhook(tries_remaining, exception);
           default None
+    jitter: None sleeps exactly delay * backoff^try number.
+          'full' sleeps a random time between 0 and that.
+          'decorrelated' sleeps a random time between delay and 3 times
+          the previous sleep.
+          Jitter keeps clients that failed together from retrying in lockstep.
+    max_delay: Upper bound of one sleep in seconds; default None
+    max_elapsed: Give up when the next retry would start later than this
+          many seconds after the first try; default None
+    budget: A RetryBudget shared between calls; no retry when it is empty
 
     The decorator will call the function up to max_tries times if it raises
     an exception.
@@ -96,10 +588,22 @@ def retries(max_tries, delay=1, backoff=2, exceptions=(Exception,), ignore_excep
 
     hook = hook or default_hook
 
+    def next_sleep(base, last_sleep):
+        if jitter == 'full':
+            sleep = random.uniform(0, base)
+        elif jitter == 'decorrelated':
+            sleep = random.uniform(delay, max(last_sleep * 3, delay))
+        else:
+            sleep = base
+        return sleep if max_delay is None else min(sleep, max_delay)
+
     def dec(func):
         @functools.wraps(func)
         def f2(*args, **kwargs):
-            mydelay = delay
+            if budget is not None:
+                budget.deposit()
+            started_at = time.time()
+            base = last_sleep = delay
             tries = range(max_tries)
             tries.reverse()
             for tries_remaining in tries:
@@ -109,10 +613,16 @@ def retries(max_tries, delay=1, backoff=2, exceptions=(Exception,), ignore_excep
                     if ignore_exceptions and isinstance(e, ignore_exceptions):
                         raise
                     if tries_remaining > 0:
+                        sleep = next_sleep(base, last_sleep)
+                        if max_elapsed is not None and time.time() + sleep - started_at > max_elapsed:
+                            raise
+                        if budget is not None and not budget.withdraw():
+                            raise
                         if hook is not None:
-                            hook(func, tries_remaining, e, mydelay)
-                        time.sleep(mydelay)
-                        mydelay = mydelay * backoff
+                            hook(func, tries_remaining, e, sleep)
+                        time.sleep(sleep)
+                        base = base * backoff
+                        last_sleep = sleep
                     else:
                         raise
                 else:
@@ -120,6 +630,116 @@ def retries(max_tries, delay=1, backoff=2, exceptions=(Exception,), ignore_excep
         return f2
     return dec
 
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    u"""
+    熔断器, 依赖出故障时直接失败, 不再调用.
+
+    closed - 正常调用, 连续failure_threshold次失败后open
+    open - 调用直接抛出CircuitOpenError, recovery_timeout秒后half-open
+    half-open - 最多放行half_open_max_calls个调用试探, 成功则closed, 失败则重新open
+
+    exceptions - 算作失败的异常类(tuple), 其他异常照常抛出, 不影响状态
+    一个CircuitBreaker可以装饰多个函数, 共享同一个状态.
+
+    >>> breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=0.1)
+    >>> @breaker
+    ... def fetch(ok):
+    ...   if not ok:
+    ...     raise IOError('down')
+    ...   return 'ok'
+    >>> for _ in range(3):
+    ...   try:
+    ...     fetch(False)
+    ...   except Exception, e:
+    ...     print type(e).__name__, breaker.state
+    IOError closed
+    IOError open
+    CircuitOpenError open
+    >>> time.sleep(0.1)
+    >>> fetch(True), breaker.state
+    ('ok', 'closed')
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30, half_open_max_calls=1, exceptions=(Exception,)):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.exceptions = exceptions
+        self.lock = threading.Lock()
+        self.failures = 0 # 连续失败次数
+        self.opened_at = None
+        self.half_open_calls = 0
+        self._state = self.CLOSED
+
+    @property
+    def state(self):
+        with self.lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == self.OPEN and time.time() - self.opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self.half_open_calls = 0
+        return self._state
+
+    def before_call(self):
+        """raise CircuitOpenError if the call is not allowed"""
+        with self.lock:
+            state = self._current_state()
+            if state == self.OPEN or (state == self.HALF_OPEN and
+                    self.half_open_calls >= self.half_open_max_calls):
+                raise CircuitOpenError('circuit open, %d failures' % self.failures)
+            if state == self.HALF_OPEN:
+                self.half_open_calls += 1
+
+    def on_success(self):
+        with self.lock:
+            self._state = self.CLOSED
+            self.failures = 0
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self.opened_at = time.time()
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def f2(*args, **kwargs):
+            self.before_call()
+            failed = False
+            try:
+                return func(*args, **kwargs)
+            except self.exceptions:
+                failed = True
+                self.on_failure()
+                raise
+            finally:
+                if not failed: # 其他异常也说明依赖有响应
+                    self.on_success()
+        return f2
+
+
+def circuit_breaker(failure_threshold=5, recovery_timeout=30, half_open_max_calls=1, exceptions=(Exception,)):
+    """Function decorator failing fast with CircuitOpenError while the
+    function keeps failing, see CircuitBreaker. The breaker is the
+    circuit_breaker attribute of the decorated function."""
+
+    def dec(func):
+        breaker = CircuitBreaker(failure_threshold, recovery_timeout, half_open_max_calls, exceptions)
+        f2 = breaker(func)
+        f2.circuit_breaker = breaker
+        return f2
+    return dec
+
 def catch_exception(hook=None, exceptions=(Exception,), log_exception=True, log_prefix=''):
     """
     The decorator will catch the exception and return the result of hook(exception).
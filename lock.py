@@ -3,7 +3,98 @@
 Lock类
 """
 
-import threading
+import bisect, errno, fcntl, os, threading, time, zlib
+
+TIME_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1, 10) # 统计直方图各档的上界(秒), 最后一档为超过10秒
+
+
+class _LockTable(object):
+    """key -> lock表
+
+    按key的hash分成多个shard, 每个shard有自己的mutex, 不同key的查找互不阻塞.
+    每个entry带引用计数(持有者+等待者), 最后一个离开时删除,
+    所以内存只与正在使用的key数量有关, 与出现过的key总数无关.
+    """
+
+    def __init__(self, shards=64, lock_factory=threading.Lock):
+        self._shards = [(threading.Lock(), {}) for _ in xrange(shards)]
+        self._lock_factory = lock_factory
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def checkout(self, key, *args):
+        """get the lock of key, creating it by lock_factory(*args) if needed,
+        and count one user"""
+        mutex, entries = self._shard(key)
+        with mutex:
+            entry = entries.get(key)
+            if entry is None:
+                entry = entries[key] = [self._lock_factory(*args), 0]
+            entry[1] += 1
+        return entry[0]
+
+    def checkin(self, key):
+        """one user of key is gone, drop the lock when it was the last"""
+        mutex, entries = self._shard(key)
+        with mutex:
+            entry = entries[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del entries[key]
+
+    def get(self, key):
+        entry = self._shard(key)[1].get(key)
+        return entry[0] if entry else None
+
+    def __len__(self):
+        return sum(len(entries) for _, entries in self._shards)
+
+
+class RWLock(object):
+    """读写锁, 读共享, 写互斥.
+    有写者等待时新的读者也要等待, 避免写者饿死, 所以读锁不可重入.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self, blocking=True):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                if not blocking:
+                    return False
+                self._cond.wait()
+            self._readers += 1
+            return True
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self, blocking=True):
+        with self._cond:
+            if self._writer or self._readers:
+                if not blocking:
+                    return False
+                self._writers_waiting += 1
+                try:
+                    while self._writer or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+            self._writer = True
+            return True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
 
 
 class KeyLock(object):
@@ -17,44 +108,351 @@ class KeyLock(object):
     lock = KeyLock('xxx')
     lock.acquire()
     lock.release()
+
+    同一个key的lock在有线程持有或等待时一直保留, 之后自动释放.
+
+    >>> with KeyLock('xxx'):
+    ...     KeyLock('xxx').acquire(blocking=False), len(KeyLock._TABLE)
+    (False, 1)
+    >>> len(KeyLock._TABLE)
+    0
     """
 
-    _LOCK_DICT = {}
+    _TABLE = _LockTable()
 
     def __init__(self, key):
         self._key = key
 
     def __enter__(self):
         self.acquire()
+        return self
 
     def __exit__(self, _type, value, traceback):
         self.release()
 
-    def acquire(self):
-        lock = KeyLock.getLock(self._key)
-        if not lock:
-            lock = KeyLock.setLock(self._key)
-
-        lock.acquire()
+    def acquire(self, blocking=True):
+        stats = _stats # 只读一次, disable_stats可能同时把它置为None
+        if stats is not None:
+            return stats.acquire(self, blocking)
+        return self._do_acquire(blocking)
 
     def release(self):
-        lock = KeyLock.getLock(self._key)
+        stats = _stats
+        if stats is not None:
+            stats.release(self)
+        self._do_release()
+
+    def _do_release(self):
+        lock = self._TABLE.get(self._key)
         if lock:
-            lock.release()
-            KeyLock.delLock(self._key)
+            self._release(lock)
+            self._TABLE.checkin(self._key)
+
+    def _do_acquire(self, blocking):
+        lock = self._checkout()
+        if not self._acquire(lock, blocking):
+            self._TABLE.checkin(self._key)
+            return False
+        return True
+
+    def _checkout(self):
+        return self._TABLE.checkout(self._key)
+
+    def _acquire(self, lock, blocking):
+        return lock.acquire(blocking)
+
+    def _release(self, lock):
+        lock.release()
 
     @classmethod
     def getLock(cls, key):
-        return cls._LOCK_DICT.get(key)
+        return cls._TABLE.get(key)
 
-    @classmethod
-    def setLock(cls, key):
-        if key not in cls._LOCK_DICT:
-            cls._LOCK_DICT[key] = threading.Lock()
 
-        return cls._LOCK_DICT[key]
+class LockStats(object):
+    """KeyLock的竞争统计, 由enable_stats开启.
+
+    key_func - 把key映射为统计的名字, 比如取key的前缀. 默认为key本身
+    max_keys - 最多统计的名字数, 超出的合并到'__other__'
+
+    持有时间只统计由获得锁的同一个KeyLock对象release的情况.
+    """
+
+    OTHER = '__other__'
+
+    def __init__(self, key_func=None, max_keys=1000):
+        self._key_func = key_func
+        self._max_keys = max_keys
+        self._mutex = threading.Lock()
+        self._stats = {}
+
+    def _entry(self, key):
+        """stats of key, must be called with self._mutex held"""
+        name = self._key_func(key) if self._key_func else key
+        entry = self._stats.get(name)
+        if entry is None:
+            if len(self._stats) >= self._max_keys:
+                name = self.OTHER
+                entry = self._stats.get(name)
+            if entry is None:
+                entry = self._stats[name] = dict(acquired=0, failed=0, waiters=0,
+                        wait_time=0.0, hold_time=0.0,
+                        wait=[0] * (len(TIME_BUCKETS) + 1), hold=[0] * (len(TIME_BUCKETS) + 1))
+        return entry
+
+    def acquire(self, keylock, blocking):
+        with self._mutex:
+            self._entry(keylock._key)['waiters'] += 1
+        start = time.time()
+        acquired = False
+        try:
+            acquired = keylock._do_acquire(blocking)
+        finally:
+            now = time.time()
+            with self._mutex:
+                entry = self._entry(keylock._key)
+                entry['waiters'] -= 1
+                if acquired:
+                    entry['acquired'] += 1
+                    entry['wait_time'] += now - start
+                    entry['wait'][bisect.bisect_left(TIME_BUCKETS, now - start)] += 1
+                else:
+                    entry['failed'] += 1
+        if acquired:
+            keylock._acquired_at = now
+        return acquired
+
+    def release(self, keylock):
+        acquired_at = keylock.__dict__.pop('_acquired_at', None)
+        if acquired_at is None: # 开启统计前获得的锁
+            return
+        hold = time.time() - acquired_at
+        with self._mutex:
+            entry = self._entry(keylock._key)
+            entry['hold_time'] += hold
+            entry['hold'][bisect.bisect_left(TIME_BUCKETS, hold)] += 1
+
+    def snapshot(self):
+        """{name: {acquired, failed, waiters, wait_time, hold_time, wait, hold}},
+        wait and hold are histograms over TIME_BUCKETS"""
+        with self._mutex:
+            return dict((name, dict(entry, wait=list(entry['wait']), hold=list(entry['hold'])))
+                    for name, entry in self._stats.iteritems())
+
+
+_stats = None
+
+
+def enable_stats(key_func=None, max_keys=1000):
+    """开始统计KeyLock及其子类的竞争情况, 关闭时只多一次判断
+
+    >>> enable_stats(key_func=lambda key: key.split(':')[0])
+    >>> with KeyLock('user:1'):
+    ...     pass
+    >>> lock = KeyLock('user:2')
+    >>> lock.acquire(), KeyLock('user:2').acquire(blocking=False)
+    (True, False)
+    >>> lock.release()
+    >>> stats = stats_snapshot()['user']
+    >>> stats['acquired'], stats['failed'], stats['waiters'], sum(stats['hold'])
+    (2, 1, 0, 2)
+    >>> disable_stats()
+    >>> stats_snapshot()
+    {}
+    """
+    global _stats
+    _stats = LockStats(key_func, max_keys)
+
+
+def disable_stats():
+    global _stats
+    _stats = None
+
+
+def stats_snapshot():
+    stats = _stats
+    return stats.snapshot() if stats is not None else {}
+
+
+_RW_TABLE = _LockTable(lock_factory=RWLock)
+
+
+class KeyReadLock(KeyLock):
+    """按key的读锁(共享), 与同key的KeyWriteLock互斥
+    @usage:
+    with KeyReadLock('xxx'):
+        pass
+
+    >>> a, b = KeyReadLock('xxx'), KeyReadLock('xxx')
+    >>> a.acquire(), b.acquire(blocking=False), KeyWriteLock('xxx').acquire(blocking=False)
+    (True, True, False)
+    >>> a.release(); b.release()
+    >>> KeyWriteLock('xxx').acquire(blocking=False)
+    True
+    >>> KeyWriteLock('xxx').release()
+    """
+
+    _TABLE = _RW_TABLE
+
+    def _acquire(self, lock, blocking):
+        return lock.acquire_read(blocking)
+
+    def _release(self, lock):
+        lock.release_read()
+
+
+class KeyWriteLock(KeyLock):
+    """按key的写锁(独占)
+    @usage:
+    with KeyWriteLock('xxx'):
+        pass
+    """
+
+    _TABLE = _RW_TABLE
+
+    def _acquire(self, lock, blocking):
+        return lock.acquire_write(blocking)
+
+    def _release(self, lock):
+        lock.release_write()
+
+
+class KeySemaphore(KeyLock):
+    """按key的信号量, 同一个key最多value个持有者.
+    value在key的第一个使用者创建信号量时确定, 同一个key应使用相同的value.
+    @usage:
+    with KeySemaphore('host', 3):
+        pass
+
+    >>> a, b, c = [KeySemaphore('host', 2) for _ in range(3)]
+    >>> a.acquire(), b.acquire(blocking=False), c.acquire(blocking=False)
+    (True, True, False)
+    >>> a.release(); b.release()
+    """
+
+    _TABLE = _LockTable(lock_factory=threading.BoundedSemaphore)
+
+    def __init__(self, key, value=1):
+        KeyLock.__init__(self, key)
+        self._value = value
+
+    def _checkout(self):
+        return self._TABLE.checkout(self._key, self._value)
+
+
+class LockTimeout(Exception):
+    pass
+
+
+def _poll(try_acquire, deadline):
+    """call try_acquire until it returns True or deadline passes"""
+    delay = 0.001
+    while not try_acquire():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+    return True
+
+
+class _SlotFile(object):
+    """进程内共享的lock文件.
+
+    关闭文件的任意一个fd会释放本进程在该文件上的所有fcntl锁, 所以每个文件只打开一次.
+    fcntl锁不区分同一进程内的线程, 所以每个slot另有一个线程锁.
+    fork出的子进程不能沿用父进程的对象(线程锁可能正被父进程的线程持有), 所以按pid缓存.
+    """
+
+    _FILES = {}
+    _FILES_LOCK = threading.Lock()
+
+    def __init__(self, path, slots):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+        self.thread_locks = [threading.Lock() for _ in xrange(slots)]
 
     @classmethod
-    def delLock(cls, key):
-        del cls._LOCK_DICT[key]
+    def get(cls, path, slots):
+        key = (os.getpid(), os.path.abspath(path), slots)
+        f = cls._FILES.get(key)
+        if f is None:
+            with cls._FILES_LOCK:
+                f = cls._FILES.get(key)
+                if f is None:
+                    f = cls._FILES[key] = cls(path, slots)
+        return f
+
+    def lockf(self, slot, flags):
+        try:
+            fcntl.lockf(self.fd, flags, 1, slot, os.SEEK_SET)
+            return True
+        except IOError as e:
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+
+
+class FileKeyLock(KeyLock):
+    """跨进程的KeyLock, 用fcntl锁住共享lock文件中key对应的字节.
+
+    key按crc32分到slots个slot中, 不会为每个key创建文件. 同一个slot的不同key会互斥,
+    所有进程必须使用相同的path和slots.
+    timeout - 秒, acquire最多等待的时间, None表示一直等待. with超时会抛出LockTimeout
+    @usage:
+    with FileKeyLock('xxx', timeout=10):
+        pass
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp()
+    >>> with FileKeyLock('xxx', path):
+    ...     FileKeyLock('xxx', path).acquire(blocking=False), FileKeyLock('yyy', path).acquire(blocking=False)
+    (False, True)
+    >>> FileKeyLock('yyy', path).release()
+    >>> FileKeyLock('xxx', path, timeout=0.01).acquire()
+    True
+    >>> FileKeyLock('xxx', path).release()
+    >>> os.remove(path)
+    """
+
+    def __init__(self, key, path='/tmp/pyutil.keylock', slots=4096, timeout=None):
+        KeyLock.__init__(self, key)
+        self.timeout = timeout
+        self._file = _SlotFile.get(path, slots)
+        name = key.encode('utf8') if isinstance(key, unicode) else str(key)
+        self._slot = (zlib.crc32(name) & 0xffffffff) % slots
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockTimeout('acquire %r timeout after %ss' % (self._key, self.timeout))
+        return self
+
+    def _do_acquire(self, blocking):
+        thread_lock = self._file.thread_locks[self._slot]
+        if not blocking:
+            if not thread_lock.acquire(False):
+                return False
+            if self._file.lockf(self._slot, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                return True
+            thread_lock.release()
+            return False
+
+        if self.timeout is None:
+            thread_lock.acquire()
+            try:
+                self._file.lockf(self._slot, fcntl.LOCK_EX)
+            except:
+                thread_lock.release()
+                raise
+            return True
+
+        deadline = time.time() + self.timeout
+        if not _poll(lambda: thread_lock.acquire(False), deadline):
+            return False
+        if _poll(lambda: self._file.lockf(self._slot, fcntl.LOCK_EX | fcntl.LOCK_NB), deadline):
+            return True
+        thread_lock.release()
+        return False
 
+    def _do_release(self):
+        self._file.lockf(self._slot, fcntl.LOCK_UN)
+        self._file.thread_locks[self._slot].release()
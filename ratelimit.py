@@ -0,0 +1,241 @@
+# coding: utf8
+"""
+限流: token bucket和sliding window, 可阻塞等待, 超时或直接拒绝, 可按key(如host, tenant)分别限流.
+兼容Python 2和3, aiofunctool.rate_limit用同样的limiter异步等待.
+
+与functool.throttle不同, 每次调用都会执行, 只是执行的频率不超过限制.
+"""
+from __future__ import division
+
+import functools, threading, time
+from collections import OrderedDict, deque
+
+
+class RateLimited(Exception):
+    pass
+
+
+class _RateLimiter(object):
+    """base of the limiters, subclasses implement _try_acquire under
+    self._lock, which only guards a few arithmetic operations"""
+
+    capacity = 0 # most permits one acquire can get
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def try_acquire(self, n=1):
+        """take n permits if available now and return 0, otherwise take
+        nothing and return the seconds to wait before trying again"""
+        if n > self.capacity:
+            raise ValueError('can not acquire %s permits, capacity is %s' % (n, self.capacity))
+        with self._lock:
+            return self._try_acquire(n, time.time())
+
+    def acquire(self, n=1, blocking=True, timeout=None):
+        """take n permits, waiting for them at most timeout seconds if
+        blocking, return whether taken"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = self.try_acquire(n)
+            if not wait:
+                return True
+            if not blocking or (deadline is not None and time.time() + wait > deadline):
+                return False
+            time.sleep(wait)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        pass
+
+
+class TokenBucket(_RateLimiter):
+    """rate permits per second on average, bursts of up to burst permits.
+
+    >>> bucket = TokenBucket(rate=10, burst=2)
+    >>> bucket.try_acquire(), bucket.try_acquire()
+    (0, 0)
+    >>> bucket.acquire(blocking=False)
+    False
+    >>> start = time.time(); bucket.acquire(); 0.05 < time.time() - start < 0.2
+    True
+    True
+    """
+
+    def __init__(self, rate, burst=None):
+        _RateLimiter.__init__(self)
+        self.rate = float(rate)
+        self.capacity = burst if burst is not None else max(rate, 1)
+        self._tokens = float(self.capacity)
+        self._updated_at = time.time()
+
+    def _try_acquire(self, n, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        if self._tokens >= n:
+            self._tokens -= n
+            return 0
+        return (n - self._tokens) / self.rate
+
+
+class SlidingWindowLog(_RateLimiter):
+    """at most limit permits in any window seconds, exact, keeps the time
+    of every permit in the window.
+
+    >>> log = SlidingWindowLog(limit=2, window=0.1)
+    >>> log.acquire(), log.acquire(), log.acquire(blocking=False)
+    (True, True, False)
+    >>> time.sleep(0.1); log.acquire(blocking=False)
+    True
+    """
+
+    def __init__(self, limit, window):
+        _RateLimiter.__init__(self)
+        self.capacity = limit
+        self.window = window
+        self._log = deque()
+
+    def _try_acquire(self, n, now):
+        log = self._log
+        while log and log[0] <= now - self.window:
+            log.popleft()
+        if len(log) + n <= self.capacity:
+            log.extend([now] * n)
+            return 0
+        # the oldest permits that must leave the window first
+        return log[len(log) + n - self.capacity - 1] + self.window - now
+
+
+class SlidingWindowCounter(_RateLimiter):
+    """about limit permits per window seconds in O(1) memory: counts the
+    permits of the current and previous fixed windows, and weights the
+    previous one by its share still inside the sliding window.
+
+    >>> counter = SlidingWindowCounter(limit=3, window=10)
+    >>> [counter.acquire(blocking=False) for _ in range(4)]
+    [True, True, True, False]
+    """
+
+    def __init__(self, limit, window):
+        _RateLimiter.__init__(self)
+        self.capacity = limit
+        self.window = window
+        self._start = time.time() # start of the current fixed window
+        self._current = 0
+        self._previous = 0
+
+    def _try_acquire(self, n, now):
+        windows = int((now - self._start) // self.window)
+        if windows:
+            self._previous = self._current if windows == 1 else 0
+            self._current = 0
+            self._start += windows * self.window
+        elapsed = now - self._start
+        previous = self._previous * (1 - elapsed / self.window)
+        if previous + self._current + n <= self.capacity:
+            self._current += n
+            return 0
+        room = self.capacity - self._current - n
+        if self._previous and room >= 0:
+            # the weight of the previous window drops enough before this one ends
+            return max(self.window * (1 - room / self._previous) - elapsed, 0.001)
+        return self.window - elapsed
+
+
+class KeyedRateLimiter(object):
+    """one limiter per key, made by factory(), e.g. a limit per host.
+
+    Looking up an existing key takes no lock, it only marks the key as
+    used. When there are more than max_keys keys one is dropped, which
+    resets its limit: keys are dropped in the order they were added, but a
+    key used since it was last passed over goes to the end instead
+    (CLOCK), so busy keys are kept and the order is approximately least
+    recently used. Only adding a key takes the lock.
+
+    >>> per_host = KeyedRateLimiter(lambda: TokenBucket(rate=1, burst=1), max_keys=2)
+    >>> per_host.acquire('a', blocking=False), per_host.acquire('b', blocking=False)
+    (True, True)
+    >>> per_host.acquire('a', blocking=False)
+    False
+    >>> per_host.acquire('c', blocking=False) # drops b, a was used later
+    True
+    >>> per_host.acquire('a', blocking=False), per_host.acquire('b', blocking=False)
+    (False, True)
+    """
+
+    def __init__(self, factory, max_keys=10000):
+        self.factory = factory
+        self.max_keys = max_keys
+        self._limiters = OrderedDict() # key -> [limiter, used], oldest added first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._limiters.get(key)
+        if entry is not None:
+            entry[1] = True
+            return entry[0]
+        with self._lock:
+            entry = self._limiters.get(key)
+            if entry is None:
+                entry = self._limiters[key] = [self.factory(), False]
+                self._evict()
+        return entry[0]
+
+    def _evict(self):
+        """drop keys until max_keys are left, giving every used key one
+        more round at the end; called under self._lock"""
+        chances = len(self._limiters) # bounds the rounds while other threads keep marking keys
+        while len(self._limiters) > self.max_keys:
+            key, entry = self._limiters.popitem(last=False)
+            if entry[1] and chances:
+                entry[1] = False
+                chances -= 1
+                self._limiters[key] = entry
+
+    def try_acquire(self, key, n=1):
+        return self.get(key).try_acquire(n)
+
+    def acquire(self, key, n=1, blocking=True, timeout=None):
+        return self.get(key).acquire(n, blocking, timeout)
+
+    def __len__(self):
+        return len(self._limiters)
+
+
+def rate_limit(limiter, key_func=None, blocking=True, timeout=None, max_keys=10000):
+    u"""
+    限制函数执行频率的decorator, 每次调用都会执行. 可作用于任何函数和方法.
+
+    limiter - TokenBucket等limiter对象; 有key_func时是生成limiter的函数, 每个key一个limiter
+    key_func - 由key_func(*args, **kwargs)计算限流的key, 如host, tenant
+    blocking - True时等待到可以执行, False时超出限制直接抛出RateLimited
+    timeout - in seconds. 最多等待的时间, 超时抛出RateLimited
+    max_keys - 有key_func时最多保留的key数
+
+    >>> @rate_limit(lambda: TokenBucket(rate=1, burst=1), key_func=lambda host: host, blocking=False)
+    ... def fetch(host):
+    ...   return host
+    >>> fetch('a'), fetch('b')
+    ('a', 'b')
+    >>> try:
+    ...   fetch('a')
+    ... except RateLimited as e:
+    ...   print(e)
+    fetch rate limited
+    """
+
+    keyed = KeyedRateLimiter(limiter, max_keys) if key_func else None
+
+    def dec(func):
+        @functools.wraps(func)
+        def limited(*args, **kwargs):
+            lim = limiter if keyed is None else keyed.get(key_func(*args, **kwargs))
+            if not lim.acquire(1, blocking, timeout):
+                raise RateLimited('%s rate limited' % func.__name__)
+            return func(*args, **kwargs)
+        limited.limiter = limiter if keyed is None else keyed
+        return limited
+    return dec
@@ -0,0 +1,400 @@
+#! /bin/env python
+# coding=utf8
+"""
+压缩bitmap (roaring bitmap), 内存占用随set bit数量而不是size增长
+"""
+
+import array, bisect, operator
+
+from bitvector import BitVector
+
+_CHUNK_BITS = 16
+_CHUNK_SIZE = 1 << _CHUNK_BITS
+_LOW_MASK = _CHUNK_SIZE - 1
+_ARRAY_MAX = 4096 # array container的最大元素数, 再多就不如8KB的bitmap省内存
+
+
+class _ArrayContainer(object):
+    """sparse chunk, sorted array of the low 16 bits"""
+
+    def __init__(self, values=()):
+        self.values = array.array('H', values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, v):
+        i = bisect.bisect_left(self.values, v)
+        return i < len(self.values) and self.values[i] == v
+
+    def add(self, v):
+        i = bisect.bisect_left(self.values, v)
+        if i < len(self.values) and self.values[i] == v:
+            return False
+        self.values.insert(i, v)
+        return True
+
+    def discard(self, v):
+        i = bisect.bisect_left(self.values, v)
+        if i == len(self.values) or self.values[i] != v:
+            return False
+        self.values.pop(i)
+        return True
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def to_bitvector(self):
+        bv = BitVector(_CHUNK_SIZE)
+        bv.set_bits(self.values)
+        return bv
+
+    def nbytes(self):
+        return len(self.values) * self.values.itemsize
+
+    def copy(self):
+        return _ArrayContainer(self.values)
+
+
+class _BitmapContainer(object):
+    """dense chunk, a 65536 bit BitVector"""
+
+    def __init__(self, bv, cardinality=None):
+        self.bv = bv
+        self.cardinality = bv.count() if cardinality is None else cardinality
+
+    def __len__(self):
+        return self.cardinality
+
+    def __contains__(self, v):
+        return self.bv.has_bit(v)
+
+    def add(self, v):
+        if self.bv.has_bit(v):
+            return False
+        self.bv.set_bit(v)
+        self.cardinality += 1
+        return True
+
+    def discard(self, v):
+        if not self.bv.has_bit(v):
+            return False
+        self.bv.clear_bit(v)
+        self.cardinality -= 1
+        return True
+
+    def __iter__(self):
+        return iter(self.bv.indexes())
+
+    def to_bitvector(self):
+        return self.bv.copy()
+
+    def nbytes(self):
+        return _CHUNK_SIZE / 8
+
+    def copy(self):
+        return _BitmapContainer(self.bv.copy(), self.cardinality)
+
+
+class _RunContainer(object):
+    """chunk of ranges, runs [starts[i], lasts[i]] sorted and not adjacent"""
+
+    def __init__(self, starts=(), lasts=()):
+        self.starts = array.array('H', starts)
+        self.lasts = array.array('H', lasts)
+
+    def __len__(self):
+        return sum(self.lasts) - sum(self.starts) + len(self.starts)
+
+    def __contains__(self, v):
+        i = bisect.bisect_right(self.starts, v) - 1
+        return i >= 0 and v <= self.lasts[i]
+
+    def add(self, v):
+        starts, lasts = self.starts, self.lasts
+        i = bisect.bisect_right(starts, v) - 1
+        if i >= 0 and v <= lasts[i]:
+            return False
+        join_prev = i >= 0 and lasts[i] + 1 == v
+        join_next = i + 1 < len(starts) and starts[i + 1] - 1 == v
+        if join_prev and join_next:
+            lasts[i] = lasts[i + 1]
+            starts.pop(i + 1)
+            lasts.pop(i + 1)
+        elif join_prev:
+            lasts[i] = v
+        elif join_next:
+            starts[i + 1] = v
+        else:
+            starts.insert(i + 1, v)
+            lasts.insert(i + 1, v)
+        return True
+
+    def discard(self, v):
+        starts, lasts = self.starts, self.lasts
+        i = bisect.bisect_right(starts, v) - 1
+        if i < 0 or v > lasts[i]:
+            return False
+        if starts[i] == lasts[i]:
+            starts.pop(i)
+            lasts.pop(i)
+        elif v == starts[i]:
+            starts[i] = v + 1
+        elif v == lasts[i]:
+            lasts[i] = v - 1
+        else:
+            starts.insert(i + 1, v + 1)
+            lasts.insert(i + 1, lasts[i])
+            lasts[i] = v - 1
+        return True
+
+    def __iter__(self):
+        for start, last in zip(self.starts, self.lasts):
+            for v in xrange(start, last + 1):
+                yield v
+
+    def to_bitvector(self):
+        bv = BitVector(_CHUNK_SIZE)
+        for start, last in zip(self.starts, self.lasts):
+            bv.set_range(start, last + 1)
+        return bv
+
+    def nbytes(self):
+        return len(self.starts) * (self.starts.itemsize + self.lasts.itemsize)
+
+    def copy(self):
+        return _RunContainer(self.starts, self.lasts)
+
+    @classmethod
+    def from_values(cls, values):
+        """build from sorted values"""
+        starts, lasts = [], []
+        for v in values:
+            if lasts and lasts[-1] + 1 == v:
+                lasts[-1] = v
+            else:
+                starts.append(v)
+                lasts.append(v)
+        return cls(starts, lasts)
+
+    def union(self, other):
+        runs = sorted(zip(self.starts, self.lasts) + zip(other.starts, other.lasts))
+        starts, lasts = [], []
+        for start, last in runs:
+            if lasts and start <= lasts[-1] + 1:
+                lasts[-1] = max(lasts[-1], last)
+            else:
+                starts.append(start)
+                lasts.append(last)
+        return _RunContainer(starts, lasts)
+
+
+def _from_values(values):
+    """container for sorted values, None if empty"""
+    if not values:
+        return None
+    if len(values) <= _ARRAY_MAX:
+        return _ArrayContainer(values)
+    bv = BitVector(_CHUNK_SIZE)
+    bv.set_bits(values)
+    return _BitmapContainer(bv, len(values))
+
+
+def _from_bitvector(bv):
+    cardinality = bv.count()
+    if cardinality == 0:
+        return None
+    if cardinality <= _ARRAY_MAX:
+        return _ArrayContainer(bv.indexes())
+    return _BitmapContainer(bv, cardinality)
+
+
+def _container_op(a, b, op):
+    if op is operator.or_ and isinstance(a, _RunContainer) and isinstance(b, _RunContainer):
+        return a.union(b)
+    if op is operator.and_ and isinstance(b, _ArrayContainer):
+        a, b = b, a
+    if op is operator.and_ and isinstance(a, _ArrayContainer):
+        return _from_values([v for v in a if v in b])
+    if isinstance(a, _ArrayContainer) and isinstance(b, _ArrayContainer):
+        return _from_values(sorted(op(set(a), set(b))))
+    return _from_bitvector(op(a.to_bitvector(), b.to_bitvector()))
+
+
+class RoaringBitmap(object):
+    """Compressed bitmap with the BitVector set_bit/has_bit interface.
+
+    the id space is split into chunks of 65536 bits by the high bits of an
+    index, and only non empty chunks are stored, each in the smallest form:
+    a sorted array for sparse chunks, a 65536 bit BitVector for dense ones,
+    and runs for ranges (set_range and run_optimize).
+
+    >>> rb = RoaringBitmap()
+    >>> rb.set_bit(1), rb.set_bit(1 << 31), rb.set_bit(1 << 32)
+    (True, True, False)
+    >>> rb.has_bit(1 << 31), rb.has_bit(2), rb.count()
+    (True, False, 2)
+    >>> rb.set_range(100000, 300000)
+    200000
+    >>> rb.count(), rb.nbytes()
+    (200002, 20)
+    >>> other = RoaringBitmap()
+    >>> other.set_bits(xrange(0, 1000000, 10))
+    100000
+    >>> (rb & other).count(), (rb | other).count(), (rb ^ other).count()
+    (20000, 280002, 260002)
+    """
+
+    def __init__(self, size=1 << 32):
+        self.size = size
+        self.containers = {} # high bits -> container
+
+    def set_bit(self, i):
+        if i < 0 or i >= self.size:
+            return False
+        high = i >> _CHUNK_BITS
+        c = self.containers.get(high)
+        if c is None:
+            c = self.containers[high] = _ArrayContainer()
+        if c.add(i & _LOW_MASK) and isinstance(c, _ArrayContainer) and len(c) > _ARRAY_MAX:
+            self.containers[high] = _BitmapContainer(c.to_bitvector(), len(c))
+        return True
+
+    def clear_bit(self, i):
+        if i < 0 or i >= self.size:
+            return False
+        high = i >> _CHUNK_BITS
+        c = self.containers.get(high)
+        if c is not None and c.discard(i & _LOW_MASK):
+            if not len(c):
+                del self.containers[high]
+            elif isinstance(c, _BitmapContainer) and len(c) <= _ARRAY_MAX:
+                self.containers[high] = _ArrayContainer(c)
+        return True
+
+    def has_bit(self, i):
+        if i < 0 or i >= self.size:
+            return False
+        c = self.containers.get(i >> _CHUNK_BITS)
+        return c is not None and (i & _LOW_MASK) in c
+
+    def set_bits(self, indexes):
+        """set every index in indexes, return the number of indexes applied"""
+        chunks = {}
+        applied = 0
+        for i in indexes:
+            if 0 <= i < self.size:
+                chunks.setdefault(i >> _CHUNK_BITS, []).append(i & _LOW_MASK)
+                applied += 1
+        for high, lows in chunks.iteritems():
+            self._merge(high, _from_values(sorted(set(lows))))
+        return applied
+
+    def has_bits(self, indexes):
+        return [self.has_bit(i) for i in indexes]
+
+    def set_range(self, start, end):
+        """set bits in [start, end), return the number of bits in the range"""
+        start, end = max(start, 0), min(end, self.size)
+        for high, low, last in self._chunk_ranges(start, end):
+            self._merge(high, _RunContainer([low], [last]))
+        return max(end - start, 0)
+
+    def clear_range(self, start, end):
+        start, end = max(start, 0), min(end, self.size)
+        for high, low, last in self._chunk_ranges(start, end):
+            c = self.containers.get(high)
+            if c is None:
+                continue
+            bv = c.to_bitvector()
+            bv.clear_range(low, last + 1)
+            self._store(high, _from_bitvector(bv))
+        return max(end - start, 0)
+
+    def _chunk_ranges(self, start, end):
+        """split [start, end) into (high, first low, last low) per chunk"""
+        while start < end:
+            high = start >> _CHUNK_BITS
+            last = min(end, (high + 1) << _CHUNK_BITS) - 1
+            yield high, start & _LOW_MASK, last & _LOW_MASK
+            start = last + 1
+
+    def _merge(self, high, container):
+        c = self.containers.get(high)
+        if c is not None and container is not None:
+            container = _container_op(c, container, operator.or_)
+        self._store(high, container)
+
+    def _store(self, high, container):
+        if container is None:
+            self.containers.pop(high, None)
+        else:
+            self.containers[high] = container
+
+    def count(self):
+        return sum(len(c) for c in self.containers.itervalues())
+
+    def nbytes(self):
+        """approximate memory of the stored chunks"""
+        return sum(c.nbytes() for c in self.containers.itervalues())
+
+    def __iter__(self):
+        """set bit positions in order"""
+        for high in sorted(self.containers):
+            base = high << _CHUNK_BITS
+            for v in self.containers[high]:
+                yield base | v
+
+    def run_optimize(self):
+        """convert chunks to runs where that takes less memory"""
+        for high, c in self.containers.items():
+            if isinstance(c, _RunContainer):
+                continue
+            runs = _RunContainer.from_values(c)
+            if runs.nbytes() < c.nbytes():
+                self.containers[high] = runs
+
+    def copy(self):
+        result = RoaringBitmap(self.size)
+        result.containers = dict((high, c.copy()) for high, c in self.containers.iteritems())
+        return result
+
+    def _binary_op(self, other, op):
+        if self.size != other.size:
+            raise ValueError('RoaringBitmap size mismatch: %d != %d' % (self.size, other.size))
+        if op is operator.and_:
+            highs = set(self.containers) & set(other.containers)
+        else:
+            highs = set(self.containers) | set(other.containers)
+        result = RoaringBitmap(self.size)
+        for high in highs:
+            a, b = self.containers.get(high), other.containers.get(high)
+            if a is None:
+                c = b.copy()
+            elif b is None:
+                c = a.copy()
+            else:
+                c = _container_op(a, b, op)
+            result._store(high, c)
+        return result
+
+    def __and__(self, other):
+        return self._binary_op(other, operator.and_)
+
+    def __or__(self, other):
+        return self._binary_op(other, operator.or_)
+
+    def __xor__(self, other):
+        return self._binary_op(other, operator.xor)
+
+    def __iand__(self, other):
+        self.containers = (self & other).containers
+        return self
+
+    def __ior__(self, other):
+        self.containers = (self | other).containers
+        return self
+
+    def __ixor__(self, other):
+        self.containers = (self ^ other).containers
+        return self
@@ -0,0 +1,34 @@
+import os, sys, threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bitvector import BitVector, ConcurrentBitVector
+
+
+def hammer(bv, thread_num=16, size=64 * 1000):
+    """every thread sets the bits i with i % thread_num == thread id,
+    so all the threads keep writing the same words"""
+    def worker(tid):
+        for i in xrange(tid, size, thread_num):
+            bv.set_bit(i)
+    threads = [threading.Thread(target=worker, args=(tid,)) for tid in xrange(thread_num)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return bv.count()
+
+
+def test_no_lost_update():
+    old_interval = sys.getcheckinterval()
+    sys.setcheckinterval(1) # switch threads as often as possible
+    try:
+        size = 64 * 1000
+        for _ in xrange(5):
+            assert hammer(ConcurrentBitVector(size, stripes=16), size=size) == size
+        print 'BitVector lost %d updates' % (size - hammer(BitVector(size), size=size))
+    finally:
+        sys.setcheckinterval(old_interval)
+
+
+if __name__ == '__main__':
+    test_no_lost_update()
+    print 'ok'
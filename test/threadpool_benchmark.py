@@ -0,0 +1,56 @@
+"""Compare the ThreadPool schedulers on many tiny tasks.
+
+python test/threadpool_benchmark.py [task_num] [thread_num]
+"""
+import imp, os, sys, time
+
+# thread.py is shadowed by the builtin thread module, load it by path
+tp = imp.load_source('pyutil_thread', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'thread.py'))
+
+
+def tiny(x):
+    return x + 1
+
+
+def spawn(pool, depth):
+    """every task queues two children, so the tasks come from the workers"""
+    if depth:
+        pool.queue_task(spawn, (pool, depth - 1))
+        pool.queue_task(spawn, (pool, depth - 1))
+
+
+def bench(name, scheduler, run, thread_num):
+    pool = tp.ThreadPool(thread_num, scheduler=scheduler)
+    start = time.time()
+    n = run(pool)
+    pool.wait_all()
+    elapsed = time.time() - start
+    pool.join_all()
+    print '%-14s %-13s %8.3fs %10.0f tasks/s' % (scheduler, name, elapsed, n / elapsed)
+
+
+def main():
+    task_num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    thread_num = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    depth = max(task_num.bit_length() - 2, 1)
+
+    def one_by_one(pool):
+        for i in xrange(task_num):
+            pool.queue_task(tiny, (i,))
+        return task_num
+
+    def batch(pool):
+        pool.queue_tasks(tiny, [(i,) for i in xrange(task_num)])
+        return task_num
+
+    def nested(pool):
+        pool.queue_task(spawn, (pool, depth))
+        return 2 ** (depth + 1) - 1
+
+    for scheduler in ('fifo', 'work_stealing'):
+        for name, run in (('one_by_one', one_by_one), ('batch', batch), ('nested', nested)):
+            bench(name, scheduler, run, thread_num)
+
+
+if __name__ == '__main__':
+    main()
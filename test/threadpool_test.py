@@ -0,0 +1,200 @@
+"""Behaviour tests of thread.ThreadPool that do not fit in a doctest.
+
+python test/threadpool_test.py
+"""
+import doctest, imp, os, subprocess, threading, time
+
+# thread.py is shadowed by the builtin thread module, load it by path
+tp = imp.load_source('pyutil_thread', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'thread.py'))
+
+SCHEDULERS = ('fifo', 'priority', 'work_stealing')
+
+
+def test_doctests():
+    """python -m doctest imports the builtin thread module instead"""
+    failed, _ = doctest.testmod(tp)
+    assert not failed
+
+
+def blocked_pool(thread_num=1, **kwargs):
+    """a pool whose threads are all stuck in a task until the returned
+    event is set"""
+    pool = tp.ThreadPool(thread_num, **kwargs)
+    release = threading.Event()
+    started = threading.Semaphore(0)
+    for _ in xrange(thread_num):
+        pool.queue_task(lambda: started.release() or release.wait())
+    for _ in xrange(thread_num):
+        started.acquire()
+    return pool, release
+
+
+def test_wait_all_latency():
+    """wait_all wakes up as soon as the last task is done, not on a poll"""
+    for scheduler in SCHEDULERS:
+        pool = tp.ThreadPool(4, scheduler=scheduler)
+        for _ in xrange(5):
+            start = time.time()
+            pool.queue_task(time.sleep, (0.05,))
+            assert pool.wait_all(timeout=5)
+            assert time.time() - start < 0.1, scheduler
+        pool.join_all()
+
+        pool, release = blocked_pool(scheduler=scheduler)
+        start = time.time()
+        assert not pool.wait_all(timeout=0.05)
+        assert 0.05 <= time.time() - start < 0.1, scheduler
+        release.set()
+        pool.join_all()
+
+
+def test_shrink_stops_threads():
+    """the threads taken out of the pool really exit, busy or idle"""
+    for scheduler in SCHEDULERS:
+        pool = tp.ThreadPool(8, scheduler=scheduler)
+        threads = pool.threads[:]
+        pool.set_thread_num(2)
+        for t in threads[2:]:
+            t.join(1)
+            assert not t.is_alive(), scheduler
+        assert all(t.is_alive() for t in threads[:2])
+        futures = pool.submit_many(abs, [(-i,) for i in xrange(100)])
+        assert sum(f.result() for f in futures) == 4950, scheduler
+        pool.join_all()
+
+        pool, release = blocked_pool(4, scheduler=scheduler)
+        threads = pool.threads[:]
+        pool.set_thread_num(1)
+        release.set() # the busy threads leave after their task
+        for t in threads[1:]:
+            t.join(1)
+            assert not t.is_alive(), scheduler
+        assert pool.get_thread_num() == 1
+        if scheduler == 'work_stealing': # the deques of the leavers are handed over
+            assert len(pool.tasks.workers) == len(pool.tasks.owners) == 1
+        pool.join_all()
+
+
+def test_join_all_cancels_queued():
+    """join_all(wait_for_tasks=False) cancels the queued futures, the
+    running task still finishes"""
+    for scheduler in SCHEDULERS:
+        pool = tp.ThreadPool(1, scheduler=scheduler)
+        release, started = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+            return 'done'
+        running = pool.submit(block)
+        started.wait()
+        queued = [pool.submit(abs, -i) for i in xrange(10)]
+        threading.Timer(0.05, release.set).start()
+        pool.join_all(wait_for_tasks=False)
+        assert running.result() == 'done', scheduler
+        assert all(f.cancelled() for f in queued), scheduler
+        assert pool.unfinished_tasks == 0 and pool.get_task_num() == 0
+        try:
+            queued[0].result()
+            assert False, 'result of a cancelled future'
+        except tp.CancelledError:
+            pass
+
+
+def test_join_all_from_task():
+    """a task can not wait for itself, but can stop the pool without waiting"""
+    pool = tp.ThreadPool(2)
+    try:
+        pool.submit(pool.join_all).result(2)
+        assert False, 'no exception'
+    except RuntimeError:
+        pass
+    assert pool.get_thread_num() == 2
+    pool.submit(pool.join_all, wait_for_tasks=False).result(2)
+    assert pool.get_thread_num() == 0
+
+
+class FakePool(object):
+    """the parts of ThreadPool an AutoScaler looks at, set by hand"""
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.depth = 0
+        self.all_tasks_done = threading.Lock()
+        self.started_tasks = 0
+        self.wait_time_total = 0.0
+        self.busy_time_total = 0.0
+        self.busy_num = 0
+
+    def get_thread_num(self):
+        return self.threads
+
+    def get_task_num(self):
+        return self.depth
+
+    def set_thread_num(self, n):
+        self.threads = n
+
+
+def test_autoscaler_adjust():
+    pool = FakePool(4)
+    scaler = tp.AutoScaler(pool, 2, 8, grow_wait=0.1, shrink_after=2)
+
+    # all busy and more queued than threads: grow by half
+    pool.depth, pool.busy_num = 10, 4
+    assert scaler.adjust() == 6 and pool.threads == 6
+    # grows no further than max_threads
+    pool.busy_num = 6
+    assert scaler.adjust() == 8
+    assert scaler.adjust() == 8
+
+    # few queued, but they waited long: grow
+    pool.threads, pool.depth, pool.busy_num = 4, 1, 4
+    pool.started_tasks += 10
+    pool.wait_time_total += 5.0
+    assert scaler.adjust() == 6
+    # few queued and they did not wait: stay
+    pool.started_tasks += 10
+    pool.wait_time_total += 0.01
+    assert scaler.adjust() == 6
+    # queued but the threads are idle, e.g. blocked on a lock: stay
+    pool.depth, pool.busy_num = 100, 0
+    assert scaler.adjust() == 6
+
+    # idle: shrink by one every shrink_after rounds, down to min_threads
+    pool.depth = 0
+    sizes = [scaler.adjust() for _ in xrange(10)]
+    assert sizes == [6, 5, 5, 4, 4, 3, 3, 2, 2, 2], sizes
+
+    # one busy round resets the idle count
+    pool.set_thread_num(4)
+    pool.busy_num = 4
+    assert scaler.adjust() == 4
+    pool.busy_num = 0
+    assert [scaler.adjust() for _ in xrange(3)] == [4, 3, 3]
+
+
+def test_process_pool_unpicklable_exception():
+    """an exception that pickles but can not be unpickled fails its own
+    task only, the pool keeps working"""
+    pool = tp.ProcessPool(1)
+    failed = pool.submit(subprocess.check_call, ['false'])
+    try:
+        failed.result(5)
+        assert False, 'no exception'
+    except RuntimeError, e:
+        assert 'CalledProcessError' in str(e), e
+    assert pool.submit(abs, -1).result(5) == 1
+    assert pool.result_handler.is_alive()
+    pool.join_all()
+
+
+if __name__ == '__main__':
+    test_doctests()
+    test_wait_all_latency()
+    test_shrink_stops_threads()
+    test_join_all_cancels_queued()
+    test_join_all_from_task()
+    test_autoscaler_adjust()
+    test_process_pool_unpicklable_exception()
+    print 'ok'
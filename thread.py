@@ -1,14 +1,603 @@
-import threading, time, math, logging
-from Queue import Queue, Empty
- 
-class ThreadPool(object):
+import threading, time, math, logging, sys, functools, random, os, traceback, tempfile, cPickle
+import multiprocessing, bisect, select
+from collections import deque
+from Queue import Queue, Empty, Full
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class CancelledError(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2 # smaller runs first
+TIME_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1, 10) # upper bounds (seconds) of the metrics histograms, the last bucket is over 10s
+
+
+class Future(object):
+    """Result of ThreadPool.submit, works like concurrent.futures.Future
+
+    >>> f = Future()
+    >>> f.result(timeout=0.01)
+    Traceback (most recent call last):
+    ...
+    TimeoutError
+    >>> f.set_running_or_notify_cancel(), f.running(), f.cancel()
+    (True, True, False)
+    >>> f.set_result(42)
+    >>> f.done(), f.result(), f.exception()
+    (True, 42, None)
+
+    >>> f = Future()
+    >>> try:
+    ...   {}['missing']
+    ... except KeyError:
+    ...   f.set_exception(sys.exc_info())
+    >>> f.exception()
+    KeyError('missing',)
+    >>> f.result()
+    Traceback (most recent call last):
+    ...
+    KeyError: 'missing'
+
+    >>> f, done = Future(), []
+    >>> f.add_done_callback(done.append)
+    >>> f.cancel(), f.cancelled(), done == [f], f.set_running_or_notify_cancel()
+    (True, True, True, False)
+    >>> f.result()
+    Traceback (most recent call last):
+    ...
+    CancelledError
+    """
+
+    PENDING, RUNNING, CANCELLED, FINISHED = 'PENDING', 'RUNNING', 'CANCELLED', 'FINISHED'
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._state = self.PENDING
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def cancel(self):
+        """cancel the task if it has not started, return whether cancelled"""
+        with self._cond:
+            if self._state == self.CANCELLED:
+                return True
+            if self._state != self.PENDING:
+                return False
+            self._state = self.CANCELLED
+            self._cond.notify_all()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == self.CANCELLED
+
+    def running(self):
+        return self._state == self.RUNNING
+
+    def done(self):
+        return self._state in (self.CANCELLED, self.FINISHED)
+
+    def _wait(self, timeout):
+        with self._cond:
+            if not self.done():
+                self._cond.wait(timeout)
+            if self._state == self.CANCELLED:
+                raise CancelledError()
+            if self._state != self.FINISHED:
+                raise TimeoutError()
+
+    def result(self, timeout=None):
+        """wait at most timeout seconds for the result, raise the exception
+        of the task if it failed"""
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def add_done_callback(self, fn):
+        """call fn(future) when the future is done, at once if it already is"""
+        with self._cond:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_running_or_notify_cancel(self):
+        """for the worker: return False if cancelled, else mark running"""
+        with self._cond:
+            if self._state == self.CANCELLED:
+                return False
+            self._state = self.RUNNING
+            return True
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        """exc_info - sys.exc_info() of the failure"""
+        self._finish(None, exc_info)
+
+    def _finish(self, result, exc_info):
+        with self._cond:
+            self._result, self._exc_info = result, exc_info
+            self._state = self.FINISHED
+            self._cond.notify_all()
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, e:
+                logging.exception(e)
+
+
+class _Task(object):
+    __slots__ = ('func', 'args', 'callback', 'future', 'priority', 'deadline', 'tenant', 'queued_at')
+
+    def __init__(self, func, args, callback=None, future=None, priority=PRIORITY_NORMAL,
+            deadline=None, tenant=None):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.future = future
+        self.priority = priority
+        self.deadline = deadline
+        self.tenant = tenant
+        self.queued_at = time.time()
+
+
+class _TaskCounters(object):
+    """Task counters of one thread. Only that thread writes them, so they
+    need no lock; ThreadPool sums the counters of all the threads."""
+    __slots__ = ('submitted', 'done', 'started', 'completed', 'failed', 'wait_time', 'busy_time',
+            'errors', 'wait_histogram', 'run_histogram')
+
+    def __init__(self):
+        self.submitted = 0 # tasks queued
+        self.done = 0 # tasks finished, run or not
+        self.started = 0
+        self.completed = 0 # run to the end, failed or not
+        self.failed = 0
+        self.wait_time = 0.0 # seconds tasks waited in the queue
+        self.busy_time = 0.0 # seconds spent running tasks
+        self.errors = {} # exception class name -> count
+        self.wait_histogram = [0] * (len(TIME_BUCKETS) + 1)
+        self.run_histogram = [0] * (len(TIME_BUCKETS) + 1)
+
+    def add(self, other):
+        for name in ('submitted', 'done', 'started', 'completed', 'failed', 'wait_time', 'busy_time'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name, n in other.errors.items():
+            self.errors[name] = self.errors.get(name, 0) + n
+        for i, n in enumerate(other.wait_histogram):
+            self.wait_histogram[i] += n
+        for i, n in enumerate(other.run_histogram):
+            self.run_histogram[i] += n
+
+
+class FifoTaskQueue(object):
+    """FIFO task queue like Queue.Queue, except that a worker blocked in get
+    is woken up by wakeup() once it is told to go away, and then gets None
+    as its poison pill."""
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.items = deque()
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.qsize()
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            if self.maxsize > 0:
+                if not block:
+                    if self.qsize() >= self.maxsize:
+                        raise Full
+                elif timeout is None:
+                    while self.qsize() >= self.maxsize:
+                        self.not_full.wait()
+                else:
+                    deadline = time.time() + timeout
+                    while self.qsize() >= self.maxsize:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise Full
+                        self.not_full.wait(remaining)
+            self._put(item)
+            self.not_empty.notify()
+
+    def put_many(self, items):
+        """put a batch of items with one synchronization, ignores maxsize"""
+        with self.mutex:
+            for item in items:
+                self._put(item)
+            self.not_empty.notify(len(items))
+
+    def get(self, thread):
+        """next item, or None when thread has been told to go away"""
+        with self.not_empty:
+            while not self.qsize():
+                if not thread.running:
+                    return None
+                self.not_empty.wait()
+            if not thread.running:
+                return None
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+    def wakeup(self):
+        """wake up all the waiting workers to check whether to go away"""
+        with self.not_empty:
+            self.not_empty.notify_all()
+
+    def clear(self):
+        """remove and return all the queued items"""
+        with self.mutex:
+            items = self._clear()
+            self.not_full.notify_all()
+        return items
+
+    # storage, called with self.mutex held
+    def _put(self, item):
+        self.items.append(item)
+
+    def _get(self):
+        return self.items.popleft()
+
+    def _clear(self):
+        items = list(self.items)
+        self.items.clear()
+        return items
+
+
+class PriorityTaskQueue(FifoTaskQueue):
+    """Task queue ordered by task priority (smaller first).
+
+    Within a priority the tenants take turns, so one tenant's backlog does
+    not delay the others. To avoid starvation, a priority that has waiting
+    tasks but was passed over max_skip times in a row gets the next turn.
+
+    >>> def run_order(queue, tasks):
+    ...   # run the (name, priority, tenant) tasks with one thread, kept busy until they are all queued
+    ...   pool, order = ThreadPool(1, scheduler=queue), []
+    ...   started, release = threading.Event(), threading.Event()
+    ...   pool.queue_task(lambda: (started.set(), release.wait()))
+    ...   started.wait()
+    ...   for name, priority, tenant in tasks:
+    ...     pool.queue_task(order.append, (name,), priority=priority, tenant=tenant)
+    ...   release.set()
+    ...   pool.join_all()
+    ...   return order
+    >>> run_order(PriorityTaskQueue(), [('low', PRIORITY_LOW, None),
+    ...     ('normal', PRIORITY_NORMAL, None), ('high', PRIORITY_HIGH, None)])
+    ['high', 'normal', 'low']
+    >>> run_order(PriorityTaskQueue(), [('a1', 1, 'a'), ('a2', 1, 'a'), ('a3', 1, 'a'), ('b1', 1, 'b')])
+    ['a1', 'b1', 'a2', 'a3']
+    >>> run_order(PriorityTaskQueue(max_skip=2), [('h%d' % i, 0, None) for i in range(1, 5)] +
+    ...     [('l1', 2, None), ('l2', 2, None)])
+    ['h1', 'h2', 'l1', 'h3', 'h4', 'l2']
+
+    A task still queued past its deadline is dropped unrun:
+
+    >>> pool, release = ThreadPool(1, scheduler='priority'), threading.Event()
+    >>> pool.queue_task(release.wait)
+    True
+    >>> soon = pool.submit_task(abs, (-1,), deadline=time.time() + 0.01)
+    >>> later = pool.submit_task(abs, (-2,), deadline=time.time() + 10)
+    >>> time.sleep(0.02); release.set()
+    >>> type(soon.exception()).__name__, later.result()
+    ('DeadlineExceeded', 2)
+    >>> pool.join_all()
+    """
+
+    def __init__(self, maxsize=0, max_skip=10):
+        FifoTaskQueue.__init__(self, maxsize)
+        self.max_skip = max_skip
+        self.size = 0
+        self.levels = {} # priority -> [tenant round robin deque, {tenant: task deque}, skipped]
+
+    def qsize(self):
+        return self.size
+
+    def _put(self, task):
+        level = self.levels.get(task.priority)
+        if level is None:
+            level = self.levels[task.priority] = [deque(), {}, 0]
+        turns, queues = level[0], level[1]
+        queue = queues.get(task.tenant)
+        if queue is None:
+            queue = queues[task.tenant] = deque()
+            turns.append(task.tenant)
+        queue.append(task)
+        self.size += 1
+
+    def _get(self):
+        waiting = sorted(p for p, level in self.levels.iteritems() if level[1])
+        chosen = waiting[0]
+        for p in waiting:
+            if self.levels[p][2] >= self.max_skip:
+                chosen = p
+                break
+        for p in waiting:
+            if p == chosen:
+                self.levels[p][2] = 0
+            else:
+                self.levels[p][2] += 1
+        turns, queues, _ = self.levels[chosen]
+        tenant = turns.popleft()
+        queue = queues[tenant]
+        task = queue.popleft()
+        if queue:
+            turns.append(tenant)
+        else:
+            del queues[tenant]
+        self.size -= 1
+        return task
+
+    def _clear(self):
+        tasks = []
+        for turns, queues, _ in self.levels.itervalues():
+            for queue in queues.itervalues():
+                tasks.extend(queue)
+        self.levels.clear()
+        self.size = 0
+        return tasks
+
+
+class WorkStealingTaskQueue(FifoTaskQueue):
+    """Task queue with one deque per worker.
+
+    Tasks queued by a worker go to its own deque and it pops them back
+    LIFO, tasks from outside go to a shared inbox and put_many spreads a
+    batch over all the deques. A worker with nothing to do steals from the
+    other end of the others' deques. deque append and pop are atomic, so
+    queuing and taking a task take no lock. maxsize is not supported.
+
+    The shared synchronization left: the mutex is taken to sleep when
+    there is no task at all, to wake the sleepers, by put_many, and when a
+    worker joins or leaves. The pool counts tasks per thread and takes its
+    all_tasks_done condition only when a task finishes with the queue
+    empty, to wake wait_all.
+    """
+
+    def __init__(self, maxsize=0):
+        FifoTaskQueue.__init__(self, 0)
+        self.inbox = deque()
+        self.workers = [] # deques, for stealing
+        self.owners = {} # thread -> its deque
+        self.sleepers = 0
+
+    def qsize(self):
+        return len(self.inbox) + sum(len(d) for d in list(self.workers))
+
+    def empty(self):
+        return not self.inbox and not any(self.workers)
+
+    def put(self, item, block=True, timeout=None):
+        own = self.owners.get(threading.current_thread())
+        (self.inbox if own is None else own).append(item)
+        if self.sleepers:
+            with self.not_empty:
+                self.not_empty.notify()
+
+    def put_many(self, items):
+        # under the mutex so that no worker retires between listing the
+        # deques and filling them, its deque would be left unserved
+        with self.mutex:
+            workers = self.workers or [self.inbox]
+            chunk = len(items) / len(workers) + 1
+            for i, d in enumerate(workers):
+                d.extend(items[i * chunk:(i + 1) * chunk])
+            if self.sleepers:
+                self.not_empty.notify_all()
+
+    def get(self, thread):
+        own = self.owners.get(thread)
+        if own is None:
+            own = deque()
+            with self.mutex:
+                self.owners[thread] = own
+                self.workers.append(own)
+        while thread.running:
+            task = self._take(own)
+            if task is not None:
+                return task
+            with self.not_empty:
+                self.sleepers += 1
+                try:
+                    # check again after counting as a sleeper, a put that
+                    # saw no sleeper has already made its task visible
+                    while thread.running:
+                        task = self._take(own)
+                        if task is not None:
+                            return task
+                        self.not_empty.wait()
+                finally:
+                    self.sleepers -= 1
+        self._retire(thread, own)
+        return None
+
+    def _take(self, own):
+        # check before pop, raising IndexError is slower than the pop itself
+        try:
+            if own:
+                return own.pop()
+            if self.inbox:
+                return self.inbox.popleft()
+        except IndexError: # taken by another thread in between
+            pass
+        workers = list(self.workers)
+        start = random.randrange(len(workers)) if workers else 0
+        for i in xrange(len(workers)):
+            victim = workers[(start + i) % len(workers)]
+            if victim:
+                try:
+                    return victim.popleft()
+                except IndexError:
+                    pass
+        return None
+
+    def _retire(self, thread, own):
+        """hand the tasks left by a leaving worker to the others"""
+        with self.mutex:
+            self.owners.pop(thread, None)
+            # by identity, empty deques compare equal
+            self.workers[:] = [d for d in self.workers if d is not own]
+            self.inbox.extend(self._drain(own))
+        if self.inbox:
+            self.wakeup()
+
+    def _drain(self, d):
+        items = []
+        while True:
+            try:
+                items.append(d.popleft())
+            except IndexError:
+                return items
+
+    def clear(self):
+        items = self._drain(self.inbox)
+        for d in list(self.workers):
+            items.extend(self._drain(d))
+        return items
+
+
+_SCHEDULERS = {
+    'fifo': FifoTaskQueue,
+    'priority': PriorityTaskQueue,
+    'work_stealing': WorkStealingTaskQueue,
+    }
+
+
+class _PoolMixin(object):
+    """methods shared by ThreadPool and ProcessPool, built on submit and
+    the unfinished_tasks accounting"""
+
+    def wait_all(self, timeout=None):
+        """  Block until every queued task has finished running. Return
+        False if timeout (in seconds) expires first."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                if deadline is None:
+                    self.all_tasks_done.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.all_tasks_done.wait(remaining)
+        return True
+
+    def _in_flight_limit(self, max_in_flight):
+        return max_in_flight or 2 * max(self.get_thread_num(), 1)
+
+    def map(self, func, iterable, max_in_flight=None):
+        """Like itertools.imap, run func on every item in the pool and yield
+        the results in order. At most max_in_flight (default twice the thread
+        number) tasks are queued or running, iterable is consumed lazily.
+
+        >>> pool, consumed = ThreadPool(2), []
+        >>> def items():
+        ...   for i in range(-100, 0):
+        ...     consumed.append(i)
+        ...     yield i
+        >>> results = pool.map(abs, items(), max_in_flight=4)
+        >>> next(results), len(consumed)
+        (100, 4)
+        >>> list(results)[-3:], len(consumed)
+        ([3, 2, 1], 100)
+        >>> pool.join_all()
+        """
+        limit = self._in_flight_limit(max_in_flight)
+        futures = deque()
+        try:
+            for item in iterable:
+                futures.append(self.submit(func, item))
+                if len(futures) >= limit:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def imap_unordered(self, func, iterable, max_in_flight=None):
+        """Like map, but yield the results as soon as they are ready.
+
+        >>> pool, consumed = ThreadPool(2), []
+        >>> def items():
+        ...   for i in range(-100, 0):
+        ...     consumed.append(i)
+        ...     yield i
+        >>> results = pool.imap_unordered(abs, items(), max_in_flight=4)
+        >>> first = next(results)
+        >>> first in (100, 99, 98, 97), len(consumed)
+        (True, 4)
+        >>> sorted([first] + list(results)) == range(1, 101), len(consumed)
+        (True, 100)
+        >>> pool.join_all()
+        """
+        limit = self._in_flight_limit(max_in_flight)
+        done = Queue()
+        pending = set()
+        try:
+            for item in iterable:
+                future = self.submit(func, item)
+                pending.add(future)
+                future.add_done_callback(done.put)
+                if len(pending) >= limit:
+                    future = done.get()
+                    pending.discard(future)
+                    yield future.result()
+            while pending:
+                future = done.get()
+                pending.discard(future)
+                yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class ThreadPool(_PoolMixin):
  
-    def __init__(self, thread_num, maxsize=0, timeout=None):
-        """Initialize the thread pool with numThreads workers."""
+    def __init__(self, thread_num, maxsize=0, timeout=None, scheduler='fifo'):
+        """Initialize the thread pool with numThreads workers.
+        scheduler - 'fifo', 'priority' (see PriorityTaskQueue), 'work_stealing'
+        (see WorkStealingTaskQueue), or a task queue object"""
         self.threads = []
         self.resize_lock = threading.Lock()
         self.timeout = timeout
-        self.tasks = Queue(maxsize)
+        if isinstance(scheduler, basestring):
+            scheduler = _SCHEDULERS[scheduler](maxsize)
+        self.tasks = scheduler
+        self.counters = {} # thread -> its _TaskCounters
+        self.retired = _TaskCounters() # sum of the counters of the threads gone
+        self.created_at = time.time()
+        self.autoscaler = None
+        self.reporter = None
+        self.all_tasks_done = threading.Condition(threading.Lock())
         self.joining = False
         self.next_thread_id = 0
         self.set_thread_num(thread_num)
@@ -48,39 +637,273 @@ class ThreadPool(object):
         """Return the number of tasks in the pool."""
         return self.tasks.qsize()
  
-    def queue_task(self, task, args=(), callback=None):
+    def queue_task(self, task, args=(), callback=None, priority=PRIORITY_NORMAL, deadline=None, tenant=None):
         """Insert a task into the queue. task must be callable;
-        args and taskCallback can be None."""
+        args and taskCallback can be None.
+        priority - smaller runs first, needs the 'priority' scheduler
+        deadline - time.time() after which the task is dropped unrun
+        tenant - tasks of different tenants take turns within a priority"""
         if self.joining:
             return False
         if not callable(task):
             return False
-        self.tasks.put((task, args, callback), block=True, timeout=self.timeout)
+        self._put(_Task(task, args, callback, None, priority, deadline, tenant))
         return True
- 
-    def get_next_task(self):
-        """  Retrieve the next task from the task queue. For use
-        only by ThreadPoolThread objects contained in the pool."""
-        return self.tasks.get()
+
+    def _put(self, item):
+        self._counters().submitted += 1
+        try:
+            self.tasks.put(item, block=True, timeout=self.timeout)
+        except:
+            self.task_done()
+            raise
+
+    def _put_many(self, items):
+        if self.tasks.maxsize > 0:
+            for item in items:
+                self._put(item)
+            return
+        self._counters().submitted += len(items)
+        self.tasks.put_many(items)
+
+    def queue_tasks(self, task, args_list, callback=None):
+        """Insert task(*args) for every args in args_list, handing the
+        whole batch to the queue at once."""
+        if self.joining or not callable(task):
+            return False
+        self._put_many([_Task(task, args, callback) for args in args_list])
+        return True
+
+    def submit_many(self, task, args_list):
+        """Batch version of submit, return the list of futures."""
+        if not callable(task):
+            raise TypeError('%r is not callable' % task)
+        if self.joining:
+            raise RuntimeError('can not submit to a joining pool')
+        tasks = [_Task(task, args, None, Future()) for args in args_list]
+        self._put_many(tasks)
+        return [t.future for t in tasks]
+
+    def submit(self, task, *args, **kwargs):
+        """Queue task(*args, **kwargs), return a Future of its result."""
+        return self.submit_task(task, args, kwargs)
+
+    def submit_task(self, task, args=(), kwargs=None, priority=PRIORITY_NORMAL, deadline=None, tenant=None):
+        """Like submit, with the scheduling options of queue_task. The
+        future of a task past its deadline fails with DeadlineExceeded."""
+        if not callable(task):
+            raise TypeError('%r is not callable' % task)
+        if kwargs:
+            task = functools.partial(task, **kwargs)
+        future = Future()
+        if self.joining:
+            raise RuntimeError('can not submit to a joining pool')
+        self._put(_Task(task, args, None, future, priority, deadline, tenant))
+        return future
+
+    def autoscale(self, min_threads, max_threads, **kwargs):
+        """  Start an AutoScaler that keeps resizing the pool between
+        min_threads and max_threads until join_all. kwargs are passed to
+        AutoScaler."""
+        if self.autoscaler:
+            self.autoscaler.stop()
+        self.autoscaler = AutoScaler(self, min_threads, max_threads, **kwargs)
+        self.autoscaler.start()
+        return self.autoscaler
+
+    def get_next_task(self, thread):
+        """  Retrieve the next task from the task queue, None if thread
+        should quit. For use only by ThreadPoolThread objects contained
+        in the pool."""
+        return self.tasks.get(thread)
+
+    def task_started(self, queued_at, thread=None):
+        """  Called by ThreadPoolThread before running a task, return the
+        start time."""
+        now = time.time()
+        counters = self._counters(thread)
+        counters.wait_time += now - queued_at
+        counters.wait_histogram[bisect.bisect_left(TIME_BUCKETS, now - queued_at)] += 1
+        counters.started += 1
+        return now
+
+    def task_done(self, started_at=None, thread=None, error=None):
+        """  Called by ThreadPoolThread after each task, finished or not.
+        error - exception class the task failed with"""
+        counters = self._counters(thread)
+        if started_at is not None:
+            run_time = time.time() - started_at
+            counters.busy_time += run_time
+            counters.run_histogram[bisect.bisect_left(TIME_BUCKETS, run_time)] += 1
+            if thread is not None:
+                thread.busy_time += run_time
+            if error is not None:
+                counters.failed += 1
+                counters.errors[error.__name__] = counters.errors.get(error.__name__, 0) + 1
+            counters.completed += 1
+        counters.done += 1
+        # while tasks are queued this was not the last one, otherwise
+        # check the total under the condition wait_all waits on
+        if self.tasks.empty():
+            with self.all_tasks_done:
+                if not self.unfinished_tasks:
+                    self.all_tasks_done.notify_all()
+
+    def thread_exited(self, thread):
+        """  Called by ThreadPoolThread once it leaves the pool."""
+        with self.all_tasks_done:
+            self._retire_counters(thread)
+
+    def _counters(self, thread=None):
+        """  The counters of thread, the current thread by default. Only
+        call it from that thread."""
+        thread = thread or threading.current_thread()
+        counters = self.counters.get(thread)
+        if counters is None:
+            counters = self.counters[thread] = _TaskCounters()
+        return counters
+
+    def _retire_counters(self, leaving=None):
+        """  Move the counters of leaving, and of the threads that have
+        exited, into self.retired. Call with all_tasks_done held."""
+        for thread, counters in self.counters.items():
+            if thread is leaving or not thread.is_alive():
+                self.retired.add(counters)
+                del self.counters[thread]
+
+    def _totals(self):
+        """  Sum of the counters of all the threads, exact with
+        all_tasks_done held."""
+        totals = _TaskCounters()
+        totals.add(self.retired)
+        for counters in self.counters.values():
+            totals.add(counters)
+        return totals
+
+    @property
+    def unfinished_tasks(self):
+        """  Tasks queued or running, exact with all_tasks_done held."""
+        done = self.retired.done + sum(c.done for c in self.counters.values())
+        # summed after done, so every task counted as done is counted as
+        # submitted too, whichever thread queued it
+        return self.retired.submitted + sum(c.submitted for c in self.counters.values()) - done
+
+    # read by AutoScaler
+    @property
+    def started_tasks(self):
+        return self._totals().started
+
+    @property
+    def wait_time_total(self):
+        return self._totals().wait_time
+
+    @property
+    def busy_time_total(self):
+        return self._totals().busy_time
+
+    @property
+    def busy_num(self):
+        """  Threads running a task."""
+        totals = self._totals()
+        return totals.started - totals.completed
+
+    def stats_snapshot(self):
+        """  Return a dict of the pool metrics, cheap enough to call often:
+
+        wait / run - histograms over TIME_BUCKETS of the seconds tasks
+            waited in the queue / ran
+        wait_avg / run_avg - average seconds
+        submitted / started / completed / failed - task counters, completed
+            counts the failed ones too
+        throughput - completed tasks per second since the pool was created
+        errors - exception class name -> number of tasks failed with it
+        thread_busy - thread_id -> share of its life the thread ran tasks
+        threads / busy / queued / unfinished - current state
+
+        >>> pool = ThreadPool(2)
+        >>> futures = [pool.submit(int, s) for s in ('1', '2', 'x')]
+        >>> pool.wait_all()
+        True
+        >>> stats = pool.stats_snapshot()
+        >>> sorted(stats)
+        ['busy', 'completed', 'errors', 'failed', 'queued', 'run', 'run_avg', 'started', 'submitted', 'thread_busy', 'threads', 'throughput', 'time', 'unfinished', 'uptime', 'wait', 'wait_avg']
+        >>> stats['submitted'], stats['started'], stats['completed'], stats['failed'], stats['errors']
+        (3, 3, 3, 1, {'ValueError': 1})
+        >>> sum(stats['wait']), sum(stats['run']), stats['threads'], stats['busy'], stats['queued'], stats['unfinished']
+        (3, 3, 2, 0, 0, 0)
+        >>> pool.join_all()
+        """
+        now = time.time()
+        with self.resize_lock:
+            threads = self.threads[:]
+        with self.all_tasks_done:
+            self._retire_counters()
+            totals = self._totals()
+        started, completed = totals.started, totals.completed
+        snapshot = dict(
+            time=now,
+            uptime=now - self.created_at,
+            threads=len(threads),
+            busy=started - completed,
+            unfinished=totals.submitted - totals.done,
+            submitted=totals.submitted,
+            started=started,
+            completed=completed,
+            failed=totals.failed,
+            errors=totals.errors,
+            wait=totals.wait_histogram,
+            run=totals.run_histogram,
+            wait_avg=totals.wait_time / started if started else 0.0,
+            run_avg=totals.busy_time / completed if completed else 0.0,
+            thread_busy=dict((t.thread_id, t.busy_time / max(now - t.created_at, 1e-6)) for t in threads),
+        )
+        snapshot['queued'] = self.get_task_num()
+        snapshot['throughput'] = completed / max(snapshot['uptime'], 1e-6)
+        return snapshot
+
+    def report_stats(self, hook, interval=10.0):
+        """  Call hook(stats_snapshot()) every interval seconds from a
+        MetricsReporter thread until join_all. The snapshot also has
+        recent_throughput, completed tasks per second since the last
+        report."""
+        if self.reporter:
+            self.reporter.stop()
+        self.reporter = MetricsReporter(self, hook, interval)
+        self.reporter.start()
+        return self.reporter
 
     def join_all(self, wait_for_tasks = True, wait_for_threads = True):
         """  Clear the task queue and terminate all pooled threads, 
-       optionally allowing the tasks and threads to finish."""
+       optionally allowing the tasks and threads to finish. A task may
+       only call it with wait_for_tasks=False, waiting for the tasks would
+       wait for itself."""
+        current = threading.current_thread()
+        if wait_for_tasks and isinstance(current, ThreadPoolThread) and current.pool is self:
+            raise RuntimeError('join_all(wait_for_tasks=True) called from a task of the pool')
         #  Mark the pool as joining to prevent any more task queueing
         self.joining = True
-        #  Wait for tasks to finish
+        for helper in (self.autoscaler, self.reporter):
+            if helper:
+                helper.stop()
+                if helper is not threading.current_thread():
+                    helper.join()
+        self.autoscaler = self.reporter = None
+        #  Wait for tasks to finish, or drop the queued ones
         if wait_for_tasks:
-            while not self.tasks.empty():
-                time.sleep(.1)
+            self.wait_all()
+        else:
+            for task in self.tasks.clear():
+                if task.future is not None:
+                    task.future.cancel()
+                self.task_done()
         #  Tell all the threads to quit
         with self.resize_lock:
-            if wait_for_threads:
-                for t in self.threads:
-                    t.go_away()
-                for t in self.threads:
-                    t.join()
-                    del t
+            threads = self.threads[:]
             self._set_thread_num_nolock(0)
+            if wait_for_threads:
+                for t in threads:
+                    if t is not threading.current_thread():
+                        t.join()
             #  Reset the pool for potential reuse
             self.joining = False
 
@@ -91,22 +914,670 @@ class ThreadPoolThread(threading.Thread):
         threading.Thread.__init__(self)
         self.setDaemon(True)
         self.pool = pool
-        self.running = False
+        self.running = True
         self.thread_id = thread_id
+        self.created_at = time.time()
+        self.busy_time = 0.0 # seconds spent running tasks
 
     def run(self):
         """  Until told to quit, retrieve the next task and execute
         it, calling the callback if any. """
-        self.running = True
-        while self.running:
+        while True:
+            # the queue answers None once the thread should quit, a
+            # work-stealing queue hands its deque over at that point
+            task = self.pool.get_next_task(self)
+            if task is None:
+                break
+            started_at = self.pool.task_started(task.queued_at, self)
+            error = None
             try:
-                cmd, args, callback = self.pool.get_next_task()
-                res = cmd(*args)
-                if callback:
-                    res = callback(res)
-            except Exception, e:
+                error = self.run_task(task)
+            finally:
+                self.pool.task_done(started_at, self, error)
+        self.pool.thread_exited(self)
+
+    def run_task(self, task):
+        """run the task, return the exception class if it failed"""
+        future = task.future
+        if future is not None and not future.set_running_or_notify_cancel():
+            return
+        if task.deadline is not None and time.time() > task.deadline:
+            if future is None:
+                logging.warn('drop task %r, deadline passed %.3fs ago', task.func, time.time() - task.deadline)
+            else:
+                future.set_exception((DeadlineExceeded, DeadlineExceeded(task.deadline), None))
+            return DeadlineExceeded
+        try:
+            res = task.func(*task.args)
+            if task.callback:
+                res = task.callback(res)
+        except Exception, e:
+            if future is None:
                 logging.exception(e)
+            else:
+                future.set_exception(sys.exc_info())
+            return type(e)
+        else:
+            if future is not None:
+                future.set_result(res)
 
     def go_away(self):
-        """  Exit the run loop next time through."""
+        """  Exit the run loop next time through, waking the thread up if
+        it is waiting for a task."""
         self.running = False
+        self.pool.tasks.wakeup()
+
+
+class AutoScaler(threading.Thread):
+    """Resize a ThreadPool between min_threads and max_threads by load.
+
+    Every interval seconds it looks at the queue depth, the average time
+    tasks waited in the queue and the share of time the threads were busy:
+
+    - grow by half (at least one thread) when tasks are queued, and either
+      waited longer than grow_wait seconds or outnumber the threads, while
+      utilization is above high_util
+    - shrink by one thread when the queue is empty and utilization stayed
+      under low_util for shrink_after intervals in a row
+
+    The gap between high_util and low_util plus shrink_after keep the pool
+    from flapping. Usually started by ThreadPool.autoscale.
+    """
+
+    def __init__(self, pool, min_threads, max_threads, interval=1.0, grow_wait=0.1,
+            high_util=0.8, low_util=0.3, shrink_after=5):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.pool = pool
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.interval = interval
+        self.grow_wait = grow_wait
+        self.high_util = high_util
+        self.low_util = low_util
+        self.shrink_after = shrink_after
+        self.idle_rounds = 0
+        self.stopped = threading.Event()
+        self.last = self._sample()
+
+    def _sample(self):
+        pool = self.pool
+        with pool.all_tasks_done:
+            return (time.time(), pool.started_tasks, pool.wait_time_total,
+                    pool.busy_time_total, pool.busy_num)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.adjust()
+            except Exception, e:
+                logging.exception(e)
+
+    def stop(self):
+        self.stopped.set()
+
+    def adjust(self):
+        """  Take one sample and resize the pool if needed, return the new
+        thread number."""
+        now, started, wait_total, busy_total, busy_num = sample = self._sample()
+        last_at, last_started, last_wait_total, last_busy_total, _ = self.last
+        self.last = sample
+        threads = self.pool.get_thread_num()
+        depth = self.pool.get_task_num()
+        elapsed = now - last_at
+        avg_wait = (wait_total - last_wait_total) / (started - last_started) if started > last_started else 0
+        if threads and elapsed > 0:
+            util = max((busy_total - last_busy_total) / (elapsed * threads), float(busy_num) / threads)
+        else:
+            util = 1.0
+        target = threads
+        if depth and (avg_wait > self.grow_wait or depth > threads) and util >= self.high_util:
+            self.idle_rounds = 0
+            target = max(threads + 1, int(threads * 1.5))
+        elif not depth and util < self.low_util:
+            self.idle_rounds += 1
+            if self.idle_rounds >= self.shrink_after:
+                self.idle_rounds = 0
+                target = threads - 1
+        else:
+            self.idle_rounds = 0
+        target = min(max(target, self.min_threads), self.max_threads)
+        if target != threads:
+            self.pool.set_thread_num(target)
+        return target
+
+
+class MetricsReporter(threading.Thread):
+    """Call hook(snapshot) with pool.stats_snapshot() every interval
+    seconds, usually started by ThreadPool.report_stats.
+
+    >>> pool, reports = ThreadPool(1), []
+    >>> reporter = MetricsReporter(pool, reports.append, interval=60)
+    >>> pool.submit(abs, -1).result(), pool.wait_all()
+    (1, True)
+    >>> reporter.report()
+    >>> reports[0]['completed'], reports[0]['recent_throughput'] > 0
+    (1, True)
+    >>> reporter = pool.report_stats(reports.append, interval=0.01)
+    >>> time.sleep(0.05); pool.join_all()
+    >>> len(reports) > 2, reporter.is_alive(), pool.reporter
+    (True, False, None)
+    """
+
+    def __init__(self, pool, hook, interval=10.0):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.pool = pool
+        self.hook = hook
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.last = pool.stats_snapshot()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.report()
+            except Exception, e:
+                logging.exception(e)
+
+    def stop(self):
+        self.stopped.set()
+
+    def report(self):
+        snapshot = self.pool.stats_snapshot()
+        elapsed = snapshot['time'] - self.last['time']
+        snapshot['recent_throughput'] = (snapshot['completed'] - self.last['completed']) / elapsed if elapsed > 0 else 0.0
+        self.last = snapshot
+        self.hook(snapshot)
+
+
+_SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+class _SharedBytes(object):
+    """A large str handed to the other process through a file in /dev/shm
+    (memory backed), so only the path goes through the pipe. The file is
+    removed once loaded."""
+
+    def __init__(self, data):
+        fd, self.path = tempfile.mkstemp(prefix='pyutil-pool-', dir=_SHM_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return f.read()
+        finally:
+            os.unlink(self.path)
+
+    def discard(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def _pack(value, threshold):
+    if threshold and isinstance(value, str) and len(value) >= threshold:
+        return _SharedBytes(value)
+    return value
+
+
+def _unpack(value):
+    return value.load() if isinstance(value, _SharedBytes) else value
+
+
+def _dumps_results(results):
+    """pickle the results of a chunk, turning the ones that can not be
+    pickled into failures instead of losing the whole chunk. Exceptions
+    that pickle but can not be rebuilt from their args (like
+    subprocess.CalledProcessError) become a RuntimeError with the remote
+    traceback."""
+    for i, (task_id, ok, value) in enumerate(results):
+        if not ok:
+            try:
+                cPickle.loads(cPickle.dumps(value, 2))
+            except Exception:
+                e, tb = value
+                results[i] = (task_id, False, (RuntimeError('can not unpickle %s raised by the task:\n%s'
+                        % (type(e).__name__, tb)), tb))
+    try:
+        return cPickle.dumps(results, 2)
+    except Exception:
+        checked = []
+        for task_id, ok, value in results:
+            try:
+                cPickle.dumps(value, 2)
+            except Exception, e:
+                ok, value = False, (RuntimeError('can not pickle %r: %s' % (value, e)), traceback.format_exc())
+            checked.append((task_id, ok, value))
+        return cPickle.dumps(checked, 2)
+
+
+def _process_worker(inq, conn, max_tasks, shm_threshold):
+    """Main loop of a ProcessPool worker: run chunks of (task_id, func,
+    args) until a None chunk, or until max_tasks tasks are done. The
+    results of a chunk go back in one message on conn, the pool sees its
+    end of conn close when the worker exits."""
+    done = 0
+    while not max_tasks or done < max_tasks:
+        chunk = inq.get()
+        if chunk is None:
+            break
+        results = []
+        for task_id, func, args in cPickle.loads(chunk):
+            try:
+                res = func(*[_unpack(arg) for arg in args])
+                results.append((task_id, True, _pack(res, shm_threshold)))
+            except Exception, e:
+                results.append((task_id, False, (e, traceback.format_exc())))
+        conn.send_bytes(_dumps_results(results))
+        done += len(results)
+
+
+def _call_batch(func, items):
+    return [func(item) for item in items]
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class WorkerLost(Exception):
+    """the worker process running the task died"""
+
+
+class _ProcessWorker(object):
+    """ProcessPool side of a worker process, with its own task queue so
+    the pool knows which tasks are lost if it dies, and its own result
+    pipe so a worker killed while writing can not block the others"""
+
+    MAX_CHUNKS = 2 # chunks queued to a worker, one running and one ready
+
+    def __init__(self, max_tasks, shm_threshold):
+        self.inq = multiprocessing.Queue()
+        self.conn, child_conn = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=_process_worker,
+                args=(self.inq, child_conn, max_tasks, shm_threshold))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close() # so self.conn reads EOF once the worker is gone
+        self.pid = self.process.pid
+        self.max_tasks = max_tasks
+        self.assigned = 0 # tasks sent over its life
+        self.chunks = deque() # (task ids, _SharedBytes args) of the chunks sent and not finished
+        self.retiring = False # will exit after the chunks sent
+
+    def free_slots(self):
+        """number of tasks it can take now"""
+        if self.retiring or len(self.chunks) >= self.MAX_CHUNKS or not self.process.is_alive():
+            return 0
+        if self.max_tasks:
+            return self.max_tasks - self.assigned
+        return sys.maxint
+
+    def send(self, task_ids, data, shared=()):
+        """shared - the _SharedBytes args of the chunk, removed if it is lost"""
+        self.chunks.append((task_ids, shared))
+        self.assigned += len(task_ids)
+        if self.max_tasks and self.assigned >= self.max_tasks:
+            self.retiring = True # exits by itself after this chunk
+        self.inq.put(data)
+
+    def retire(self):
+        self.retiring = True
+        self.inq.put(None)
+
+    def close(self):
+        self.process.join()
+        self.inq.close()
+        self.conn.close()
+
+
+class ProcessPool(_PoolMixin):
+    """Pool of worker processes with the ThreadPool interface, for CPU bound
+    tasks that a ThreadPool can not speed up because of the GIL.
+
+    - task, args and results must be picklable, so use module level functions
+    - callbacks run in this process, on the result handler thread
+    - a dispatcher thread sends the queued tasks in chunks of at most
+      chunksize (smaller when there are few tasks per process), so one
+      pickle and one pipe round trip are shared by a whole chunk; map and
+      imap_unordered submit the items chunksize at a time too
+    - a worker is replaced by a fresh process after max_tasks_per_child
+      tasks, to cap the memory growth of leaky tasks
+    - str args and results of at least shm_threshold bytes go through
+      /dev/shm instead of the pipe, 0 to disable
+    - the tasks of a worker that dies fail with WorkerLost as soon as its
+      result pipe closes, and it gets no new tasks; workers are also
+      checked every CHECK_INTERVAL seconds
+
+    >>> pool = ProcessPool(2, chunksize=4, max_tasks_per_child=5)
+    >>> list(pool.map(abs, range(-10, 0)))
+    [10, 9, 8, 7, 6, 5, 4, 3, 2, 1]
+    >>> pool.submit(len, 'x' * (2 << 20)).result()
+    2097152
+    >>> pool.join_all()
+    >>> pool.get_thread_num()
+    0
+    """
+
+    CHECK_INTERVAL = 0.5 # seconds between looking for dead workers
+
+    def __init__(self, process_num, chunksize=32, max_tasks_per_child=None, shm_threshold=1 << 20):
+        self.chunksize = max(chunksize, 1)
+        self.max_tasks_per_child = max_tasks_per_child
+        self.shm_threshold = shm_threshold
+        self.wakeup, self.waker = multiprocessing.Pipe(duplex=False) # new workers for the result handler
+        self.workers = {} # pid -> _ProcessWorker
+        self.process_num = 0
+        self.pending = deque() # (task_id, task) not dispatched yet
+        self.in_flight = {} # task_id -> task
+        self.next_task_id = 0
+        self.lock = threading.Condition(threading.RLock()) # guards all of the above
+        self.unfinished_tasks = 0
+        self.all_tasks_done = threading.Condition(threading.Lock())
+        self.joining = False
+        self.stopping = False
+        self.dispatcher = self.result_handler = None
+        self.set_thread_num(process_num)
+
+    def set_thread_num(self, new_process_num):
+        """Set the number of worker processes, False if the pool is joining."""
+        if self.joining:
+            return False
+        with self.lock:
+            self._set_thread_num_nolock(new_process_num)
+        return True
+
+    def _set_thread_num_nolock(self, new_process_num):
+        self.process_num = new_process_num
+        self._start_helpers()
+        self._adjust_nolock()
+
+    def _adjust_nolock(self):
+        """spawn or retire processes until the ones not retiring match
+        process_num"""
+        live = [w for w in self.workers.itervalues() if not w.retiring]
+        for _ in xrange(len(live), self.process_num):
+            worker = _ProcessWorker(self.max_tasks_per_child, self.shm_threshold)
+            self.workers[worker.pid] = worker
+            self.waker.send_bytes('')
+        live.sort(key=lambda w: len(w.chunks))
+        for worker in live[:max(len(live) - self.process_num, 0)]:
+            worker.retire()
+        self.lock.notify_all()
+
+    def get_thread_num(self):
+        """Return the number of worker processes."""
+        with self.lock:
+            return self.process_num
+
+    def get_task_num(self):
+        """Return the number of tasks waiting to be dispatched."""
+        return len(self.pending)
+
+    def _start_helpers(self):
+        if self.dispatcher is None or not self.dispatcher.is_alive():
+            self.stopping = False
+            self.dispatcher = threading.Thread(target=self._dispatch_loop, name='ProcessPool-dispatcher')
+            self.result_handler = threading.Thread(target=self._result_loop, name='ProcessPool-results')
+            for t in (self.dispatcher, self.result_handler):
+                t.setDaemon(True)
+                t.start()
+
+    def queue_task(self, task, args=(), callback=None):
+        """Insert a task into the queue, callback(result) runs in this
+        process when it finishes."""
+        if self.joining or not callable(task):
+            return False
+        self._put_many([_Task(task, args, callback)])
+        return True
+
+    def queue_tasks(self, task, args_list, callback=None):
+        """Insert task(*args) for every args in args_list."""
+        if self.joining or not callable(task):
+            return False
+        self._put_many([_Task(task, args, callback) for args in args_list])
+        return True
+
+    def submit(self, task, *args, **kwargs):
+        """Queue task(*args, **kwargs), return a Future of its result."""
+        return self.submit_many(functools.partial(task, **kwargs) if kwargs else task, [args])[0]
+
+    def submit_many(self, task, args_list):
+        """Batch version of submit, return the list of futures."""
+        if not callable(task):
+            raise TypeError('%r is not callable' % task)
+        if self.joining:
+            raise RuntimeError('can not submit to a joining pool')
+        tasks = [_Task(task, args, None, Future()) for args in args_list]
+        self._put_many(tasks)
+        return [t.future for t in tasks]
+
+    def map(self, func, iterable, max_in_flight=None):
+        """Like ThreadPool.map, max_in_flight counts chunks of chunksize items."""
+        for results in _PoolMixin.map(self, functools.partial(_call_batch, func),
+                _batched(iterable, self.chunksize), max_in_flight):
+            for res in results:
+                yield res
+
+    def imap_unordered(self, func, iterable, max_in_flight=None):
+        """Like ThreadPool.imap_unordered, the items of a chunk stay in order."""
+        for results in _PoolMixin.imap_unordered(self, functools.partial(_call_batch, func),
+                _batched(iterable, self.chunksize), max_in_flight):
+            for res in results:
+                yield res
+
+    def _put_many(self, tasks):
+        with self.all_tasks_done:
+            self.unfinished_tasks += len(tasks)
+        with self.lock:
+            for task in tasks:
+                self.pending.append((self.next_task_id, task))
+                self.next_task_id += 1
+            self.lock.notify_all()
+
+    def task_done(self, n=1):
+        with self.all_tasks_done:
+            self.unfinished_tasks -= n
+            if not self.unfinished_tasks:
+                self.all_tasks_done.notify_all()
+
+    def _next_chunk(self):
+        """wait for tasks and a worker to take them, return (worker,
+        chunk), None when stopping"""
+        with self.lock:
+            while True:
+                if self.stopping:
+                    return None
+                if self.pending:
+                    workers = [w for w in self.workers.itervalues() if w.free_slots()]
+                    if workers:
+                        break
+                self.lock.wait()
+            worker = min(workers, key=lambda w: len(w.chunks))
+            size = min(self.chunksize, worker.free_slots(),
+                    -(-len(self.pending) // max(len(workers), 1)))
+            chunk = []
+            while self.pending and len(chunk) < size:
+                task_id, task = self.pending.popleft()
+                if task.future is not None and not task.future.set_running_or_notify_cancel():
+                    self.task_done()
+                    continue
+                chunk.append((task_id, task))
+                self.in_flight[task_id] = task
+            return worker, chunk
+
+    def _dispatch_loop(self):
+        while True:
+            item = self._next_chunk()
+            if item is None:
+                return
+            worker, chunk = item
+            if not chunk:
+                continue
+            items = [(task_id, task.func, [_pack(arg, self.shm_threshold) for arg in task.args])
+                    for task_id, task in chunk]
+            try:
+                data = cPickle.dumps(items, 2)
+            except Exception:
+                data, items = self._dumps_picklable(items)
+            if data is None:
+                continue
+            with self.lock:
+                if not worker.retiring and self.workers.get(worker.pid) is worker:
+                    worker.send([task_id for task_id, _, _ in items], data,
+                            [arg for _, _, args in items for arg in args if isinstance(arg, _SharedBytes)])
+                    continue
+                # retired or died while the chunk was pickled, queue it again
+                for task_id, _, args in reversed(items):
+                    self.pending.appendleft((task_id, self.in_flight.pop(task_id)))
+                    for arg in args:
+                        if isinstance(arg, _SharedBytes):
+                            arg.discard()
+
+    def _dumps_picklable(self, items):
+        """fail the tasks that can not be pickled, pickle the rest"""
+        good = []
+        for item in items:
+            try:
+                cPickle.dumps(item, 2)
+                good.append(item)
+            except Exception:
+                exc_info = sys.exc_info()
+                for arg in item[2]:
+                    if isinstance(arg, _SharedBytes):
+                        arg.discard()
+                self._finish(item[0], False, exc_info)
+        return (cPickle.dumps(good, 2) if good else None), good
+
+    def _finish(self, task_id, ok, value):
+        with self.lock:
+            task = self.in_flight.pop(task_id)
+        future = task.future
+        try:
+            if not ok:
+                exc_info = value
+                if len(value) == 2: # (exception, remote traceback)
+                    e, e.remote_traceback = value
+                    exc_info = (type(e), e, None)
+                if future is None:
+                    logging.error('task %r failed: %s', task.func, getattr(exc_info[1], 'remote_traceback', exc_info[1]))
+                else:
+                    future.set_exception(exc_info)
+                return
+            try:
+                res = _unpack(value)
+                if task.callback:
+                    res = task.callback(res)
+            except Exception, e:
+                if future is None:
+                    logging.exception(e)
+                else:
+                    future.set_exception(sys.exc_info())
+            else:
+                if future is not None:
+                    future.set_result(res)
+        finally:
+            self.task_done()
+
+    def _result_loop(self):
+        checked_at = time.time()
+        while True:
+            with self.lock:
+                if self.stopping and not self.workers:
+                    return
+                conns = dict((w.conn.fileno(), w) for w in self.workers.itervalues())
+            conns[self.wakeup.fileno()] = None
+            try:
+                for fd in select.select(list(conns), [], [], self.CHECK_INTERVAL)[0]:
+                    if conns[fd] is None:
+                        while self.wakeup.poll():
+                            self.wakeup.recv_bytes()
+                    else:
+                        self._read_results(conns[fd])
+                if time.time() - checked_at >= self.CHECK_INTERVAL:
+                    self._check_workers()
+                    checked_at = time.time()
+            except Exception, e: # the pool is stuck if this thread exits
+                logging.exception(e)
+
+    def _read_results(self, worker):
+        """finish the tasks of the next chunk of worker, False when it is gone"""
+        try:
+            data = worker.conn.recv_bytes()
+        except (EOFError, IOError):
+            self._worker_exited(worker)
+            return False
+        try:
+            results = cPickle.loads(data)
+        except Exception:
+            # fail the tasks of this chunk only
+            results = [(task_id, False, sys.exc_info()) for task_id in worker.chunks[0][0]]
+        for task_id, ok, value in results:
+            try:
+                self._finish(task_id, ok, value)
+            except Exception, e:
+                logging.exception(e)
+        with self.lock:
+            worker.chunks.popleft()
+            self.lock.notify_all()
+        return True
+
+    def _worker_exited(self, worker):
+        """fail the tasks a worker took with it and replace it"""
+        with self.lock:
+            if self.workers.get(worker.pid) is not worker:
+                return
+            del self.workers[worker.pid]
+            worker.close()
+            if worker.process.exitcode:
+                logging.error('pool worker %d died with exit code %d', worker.pid, worker.process.exitcode)
+            lost = [task_id for task_ids, _ in worker.chunks for task_id in task_ids]
+            for _, shared in worker.chunks: # not loaded if it died first
+                for arg in shared:
+                    arg.discard()
+            self._adjust_nolock()
+        for task_id in lost:
+            self._finish(task_id, False, (WorkerLost, WorkerLost('worker process died'), None))
+
+    def _check_workers(self):
+        """in case a dead worker's pipe is held open by another process,
+        read what it sent and let it go"""
+        with self.lock:
+            dead = [w for w in self.workers.itervalues() if not w.process.is_alive()]
+        for worker in dead:
+            while worker.conn.poll() and self._read_results(worker):
+                pass
+            self._worker_exited(worker)
+
+    def join_all(self, wait_for_tasks=True, wait_for_threads=True):
+        """Stop all the worker processes, optionally letting the queued
+        tasks and the processes finish first."""
+        self.joining = True
+        if wait_for_tasks:
+            self.wait_all()
+        else:
+            with self.lock:
+                pending, self.pending = self.pending, deque()
+            for _, task in pending:
+                if task.future is not None:
+                    task.future.cancel()
+            self.task_done(len(pending))
+        with self.lock:
+            self._set_thread_num_nolock(0)
+            self.stopping = True
+            self.lock.notify_all()
+        if wait_for_threads:
+            self.dispatcher.join()
+            self.result_handler.join()
+        self.joining = False